@@ -0,0 +1,105 @@
+#
+# A fake mpd server, speaking just enough of mpd's protocol for testing
+# volumed's MPDClient: status, setvol, command lists, idle and noidle.
+#
+
+import socket
+import threading
+
+
+class FakeMPD(threading.Thread):
+    """Serve mpd's protocol on a local port, recording the commands
+    received.  Each connection is handled by a thread of its own."""
+
+    def __init__(self):
+        super(FakeMPD, self).__init__()
+        self.daemon = True
+        self.server = socket.socket()
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        self.port = self.server.getsockname()[1]
+        self.volume = 50
+        self.connections = []
+        self.commands = []
+        self.idlers = []
+        self.lock = threading.Lock()
+
+    def run(self):
+        while True:
+            try:
+                conn, addr = self.server.accept()
+            except socket.error:
+                return
+            self.connections.append(conn)
+            thread = threading.Thread(target=self.handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        self.server.close()
+        self.drop_connections()
+
+    def drop_connections(self):
+        """Close every client connection, as a restarted mpd would."""
+        for conn in self.connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+                conn.close()
+            except socket.error:
+                pass
+        self.connections = []
+
+    def handle(self, conn):
+        rfile = conn.makefile('rb')
+        conn.sendall('OK MPD 0.19.0\n')
+        in_list = False
+        replies = ''
+        while True:
+            try:
+                line = rfile.readline()
+            except socket.error:
+                return
+            if not line:
+                return
+            line = line.strip()
+            with self.lock:
+                self.commands.append(line)
+            if line == 'command_list_ok_begin':
+                in_list, replies = True, ''
+            elif line == 'command_list_end':
+                conn.sendall(replies + 'OK\n')
+                in_list = False
+            else:
+                reply = self.execute(conn, line)
+                if reply is None:
+                    continue
+                if reply.startswith('ACK'):
+                    conn.sendall(reply)
+                elif in_list:
+                    replies += reply + 'list_OK\n'
+                else:
+                    conn.sendall(reply + 'OK\n')
+
+    def execute(self, conn, line):
+        """Return the reply to a command, less its OK, or None if the
+        reply is to be sent later."""
+        if line == 'status':
+            return 'volume: %d\nrepeat: 0\nstate: play\n' % self.volume
+        if line.startswith('setvol '):
+            self.volume = int(line.split()[1])
+            with self.lock:
+                idlers, self.idlers = self.idlers, []
+            for idler in idlers:
+                idler.sendall('changed: mixer\nOK\n')
+            return ''
+        if line.startswith('idle'):
+            with self.lock:
+                self.idlers.append(conn)
+            return None
+        if line == 'noidle':
+            with self.lock:
+                if conn in self.idlers:
+                    self.idlers.remove(conn)
+            return ''
+        return 'ACK [5@0] {%s} unknown command\n' % line.split()[0]
@@ -0,0 +1,79 @@
+#
+# Tests for volumed's per-connection admission control and the merging
+# of commands beyond a connection's quota.
+#
+# Run from the top of the repository with:
+#   python -m unittest discover tests
+#
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'www'))
+import unittest
+
+from volumed import TokenBucket, MergedCommands
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_burst_then_refused(self):
+        bucket = TokenBucket(10, 3)
+        self.assertEqual([bucket.take() for i in range(4)],
+                         [True, True, True, False])
+
+    def test_refills_at_rate(self):
+        bucket = TokenBucket(10, 3)
+        for i in range(3):
+            bucket.take()
+        bucket.updated -= 0.1
+        self.assertTrue(bucket.take())
+        self.assertFalse(bucket.take())
+
+    def test_refill_is_limited_to_burst(self):
+        bucket = TokenBucket(10, 2)
+        bucket.updated -= 60
+        self.assertEqual([bucket.take() for i in range(3)],
+                         [True, True, False])
+
+
+class MergedCommandsTest(unittest.TestCase):
+
+    def merge(self, *commands):
+        merged = MergedCommands()
+        for cmd, val in commands:
+            merged.add(cmd, val)
+        return merged.commands()
+
+    def test_deltas_accumulate(self):
+        self.assertEqual(self.merge(('delta', 1), ('delta', 1),
+                                    ('delta', -3)),
+                         [('delta', -1)])
+
+    def test_set_absorbs_later_deltas(self):
+        self.assertEqual(self.merge(('delta', 4), ('set', 50),
+                                    ('delta', 5), ('delta', -2)),
+                         [('set', 53)])
+
+    def test_last_mute_wins(self):
+        self.assertEqual(self.merge(('mute', 0), ('unmute', 0)),
+                         [('unmute', 0)])
+        self.assertEqual(self.merge(('unmute', 0), ('mute', 0)),
+                         [('mute', 0)])
+
+    def test_net_result(self):
+        self.assertEqual(self.merge(('set', 50), ('delta', 5), ('mute', 0),
+                                    ('unmute', 0), ('get', None)),
+                         [('set', 55), ('unmute', 0), ('get', None)])
+
+    def test_refresh_answers_queries(self):
+        self.assertEqual(self.merge(('get', None), ('refresh', None)),
+                         [('refresh', None)])
+
+    def test_cancelled_deltas_still_answered(self):
+        self.assertEqual(self.merge(('delta', 2), ('delta', -2)),
+                         [('delta', 0)])
+
+
+if __name__ == '__main__':
+    unittest.main()
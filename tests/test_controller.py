@@ -0,0 +1,158 @@
+#
+# Tests for the ordering of commands through VolumeController's lanes,
+# using a simulated mixer with a fixed latency.
+#
+# Run from the top of the repository with:
+#   python -m unittest discover tests
+#
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'www'))
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+import volumed
+from test_db import FIELDS
+
+LATENCY = 0.2
+
+
+class Options:
+    emulate = False
+    simulate = 'latency=%d' % (LATENCY * 1000)
+    amixer = False
+    curve = 'linear'
+    mpd_host = 'localhost'
+    mpd_port = 6600
+    poll = False
+    max_rate = 20.0
+    max_age = 5.0
+    wal = False
+    zones = []
+    members = []
+    state_file = ''
+    fast_start = False
+    queue_size = 256
+    client_rate = 0
+    client_burst = 100
+
+
+class Client:
+    """Stands in for a connection, recording the responses sent to it."""
+
+    def __init__(self):
+        self.responses = []
+
+    def send(self, msg):
+        self.responses.append((time.time(), msg.strip()))
+
+    def close(self):
+        pass
+
+    def wait(self, count, timeout=3.0):
+        limit = time.time() + timeout
+        while len(self.responses) < count and time.time() < limit:
+            time.sleep(0.01)
+        return [msg for sent_at, msg in self.responses]
+
+
+class ControllerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(class_):
+        class_.dir = tempfile.mkdtemp()
+        Options.db = os.path.join(class_.dir, 'player.db')
+        connection = sqlite3.connect(Options.db)
+        connection.execute("create table cfg_engine (id integer primary "
+                           "key, param char(20), value char(32))")
+        connection.executemany("insert into cfg_engine values (?, ?, ?)",
+                               FIELDS)
+        connection.commit()
+        connection.close()
+        class_.zones = volumed.VolumeZones(Options())
+
+    @classmethod
+    def tearDownClass(class_):
+        class_.zones.stop()
+        class_.zones.join()
+        shutil.rmtree(class_.dir)
+
+    def setUp(self):
+        client = self.command(['vol 60', 'unmute'])
+        client.wait(2)
+        time.sleep(0.1)
+
+    def command(self, messages, client=None):
+        client = client or Client()
+        for message in messages:
+            self.zones.process_message(client, message)
+        return client
+
+    def test_query_follows_own_volume_change(self):
+        client = self.command(['vol 50', 'vol'])
+        self.assertEqual(set(client.wait(2)), set(['Vol: 50, Mute: off']))
+
+    def test_query_answered_without_hardware(self):
+        client = Client()
+        start = time.time()
+        self.command(['vol'], client)
+        self.assertEqual(client.wait(1), ['Vol: 60, Mute: off'])
+        self.assertTrue(client.responses[0][0] - start < LATENCY / 2)
+
+    def test_mute_does_not_wait_for_volume_write(self):
+        setter = self.command(['vol 30'])
+        time.sleep(LATENCY / 4)
+        start = time.time()
+        muter = self.command(['mute'])
+        # The pending level is reported, not the one last written.
+        self.assertEqual(muter.wait(1), ['Vol: 30, Mute: on'])
+        # Had it waited for the volume write, this would have taken
+        # close to twice the latency.
+        self.assertTrue(muter.responses[0][0] - start < LATENCY * 1.5)
+        self.assertEqual(setter.wait(1)[-1][:7], 'Vol: 30')
+
+    def test_unmute_follows_volume_decrease(self):
+        self.command(['mute']).wait(1)
+        client = self.command(['vol 10', 'unmute'])
+        self.assertEqual(client.wait(2),
+                         ['Vol: 10, Mute: on', 'Vol: 10, Mute: off'])
+
+    def test_net_mute_state(self):
+        client = self.command(['mute', 'unmute', 'mute', 'vol'])
+        responses = client.wait(4)
+        time.sleep(LATENCY * 3)
+        self.assertEqual(self.command(['vol']).wait(1),
+                         ['Vol: 60, Mute: on'])
+        self.assertEqual(responses[-1], 'Vol: 60, Mute: on')
+
+    def test_errors_are_answered_together(self):
+        client = Client()
+        client.protocol = 'json'
+        self.command(['; '.join(['x%d' % i for i in range(9)])], client)
+        self.assertEqual(client.wait(1), [
+            '{"cmd":"x0; x1; x2; x3; x4; x5; x6; x7; x8",'
+            '"error":"unknown command"}'])
+        self.assertTrue(client in self.zones.writers)
+
+    def test_refusals_are_answered_together(self):
+        client = Client()
+        client.protocol = 'json'
+        self.zones.client_rate, self.zones.client_burst = 1, 1
+        try:
+            self.command(['x1; x2; x3'], client)
+        finally:
+            self.zones.client_rate = Options.client_rate
+            self.zones.client_burst = Options.client_burst
+        self.assertEqual(sorted(client.wait(2)), [
+            '{"cmd":"x1","error":"unknown command"}',
+            '{"cmd":"x2; x3","error":"rate limited"}'])
+        self.assertTrue(client in self.zones.writers)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+#
+# Tests for volumed's volume curve lookup tables.
+#
+# Run from the top of the repository with:
+#   python -m unittest discover tests
+#
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'www'))
+import unittest
+
+from volumed import VolumeCurve
+
+
+class VolumeCurveTest(unittest.TestCase):
+
+    def curves(self):
+        return [VolumeCurve.linear(0, 207),
+                VolumeCurve.linear(0, 100),
+                VolumeCurve.logarithmic(0, 255, 56),
+                VolumeCurve.logarithmic(-10239, 400, 100),
+                VolumeCurve.db_linear(0, 207, -5000, 0,
+                                      lambda db: 207 + db / 50.0)]
+
+    def test_percentages_round_trip(self):
+        for curve in self.curves():
+            for pct in range(101):
+                self.assertEqual(curve.to_pct(curve.to_raw(pct)), pct)
+
+    def test_raw_values_round_trip(self):
+        for curve in self.curves():
+            for pct in range(101):
+                raw = curve.to_raw(pct)
+                self.assertEqual(curve.to_raw(curve.to_pct(raw)), raw)
+
+    def test_each_percentage_has_its_own_raw_value(self):
+        for curve in self.curves():
+            self.assertEqual(len(set(curve.forward)), 101)
+            self.assertEqual(curve.forward, sorted(curve.forward))
+
+    def test_range_is_respected(self):
+        curve = VolumeCurve.linear(-100, 300)
+        self.assertEqual(curve.to_raw(0), -100)
+        self.assertEqual(curve.to_raw(100), 300)
+        self.assertEqual(curve.to_raw(-5), -100)
+        self.assertEqual(curve.to_raw(150), 300)
+
+    def test_other_raw_values_map_to_nearest(self):
+        curve = VolumeCurve.linear(0, 1000)
+        self.assertEqual(curve.to_pct(504), 50)
+        self.assertEqual(curve.to_pct(506), 51)
+        self.assertEqual(curve.to_pct(-20), 0)
+        self.assertEqual(curve.to_pct(2000), 100)
+
+    def test_small_range(self):
+        # With fewer than 101 raw values, percentages must share them.
+        curve = VolumeCurve.linear(0, 10)
+        self.assertEqual(curve.to_raw(50), 5)
+        for raw in range(11):
+            self.assertEqual(curve.to_raw(curve.to_pct(raw)), raw)
+
+
+if __name__ == '__main__':
+    unittest.main()
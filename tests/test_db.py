@@ -0,0 +1,86 @@
+#
+# Tests for volumed's write-behind access to moode's database.
+#
+# Run from the top of the repository with:
+#   python -m unittest discover tests
+#
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'www'))
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import volumed
+
+
+FIELDS = [(32, 'volcurve', 'No'), (34, 'volmaxpct', '100'),
+          (35, 'volknob', '30'), (36, 'volmute', 'False'),
+          (37, 'volwarning', '80'), (39, 'amixname', 'PCM'),
+          (40, 'mpdmixer', 'hardware'), (56, 'volcurvefac', '56')]
+
+
+class DBTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'player.db')
+        connection = sqlite3.connect(self.path)
+        connection.execute("create table cfg_engine (id integer primary "
+                           "key, param char(20), value char(32))")
+        connection.executemany("insert into cfg_engine values (?, ?, ?)",
+                               FIELDS)
+        connection.commit()
+        connection.close()
+        self.db = volumed.DB(self.path)
+        self.other = sqlite3.connect(self.path)
+
+    def tearDown(self):
+        self.db.close()
+        self.other.close()
+        shutil.rmtree(self.dir)
+
+    def stored(self, id):
+        return self.other.execute("select value from cfg_engine where "
+                                  "id = ?", (id,)).fetchone()[0]
+
+    def external_update(self, id, value):
+        self.other.execute("update cfg_engine set value = ? where id = ?",
+                           (value, id))
+        self.other.commit()
+
+    def test_flush(self):
+        self.db.level = 42
+        self.assertEqual(self.stored(35), '30')
+        self.db.flush()
+        self.assertEqual(self.stored(35), '42')
+
+    def test_pending_update_survives_other_change(self):
+        # A commit by another writer to some other field must not lose
+        # an unflushed update, even one previously flushed as an int.
+        self.db.level = 42
+        self.db.flush()
+        self.db.level = 50
+        self.external_update(37, '70')
+        self.db.refresh(True)
+        self.assertEqual(self.db.level, 50)
+        self.assertEqual(self.db.warning_level, '70')
+        self.db.flush()
+        self.assertEqual(self.stored(35), '50')
+
+    def test_other_change_to_same_field_wins(self):
+        self.db.level = 42
+        self.db.flush()
+        self.db.level = 50
+        self.external_update(35, '20')
+        self.db.refresh(True)
+        self.assertEqual(self.db.level, '20')
+        self.db.flush()
+        self.assertEqual(self.stored(35), '20')
+
+
+if __name__ == '__main__':
+    unittest.main()
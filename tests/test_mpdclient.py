@@ -0,0 +1,142 @@
+#
+# Tests for volumed's mpd client, against a local fake mpd server.
+#
+# Run from the top of the repository with:
+#   python -m unittest discover tests
+#
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'www'))
+import select
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+import volumed
+from fakempd import FakeMPD
+import test_controller
+from test_db import FIELDS
+
+
+class MPDClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mpd = FakeMPD()
+        self.mpd.start()
+        self.client = volumed.MPDClient('127.0.0.1', self.mpd.port,
+                                        timeout=2.0)
+
+    def tearDown(self):
+        self.client.disconnect()
+        self.mpd.stop()
+
+    def test_get_volume(self):
+        self.mpd.volume = 37
+        self.assertEqual(self.client.get_volume(), 37)
+
+    def test_set_volume(self):
+        self.assertEqual(self.client.set_volume(64), 64)
+        self.assertEqual(self.mpd.volume, 64)
+        # The write and the read back are a single command list.
+        self.assertEqual(self.mpd.commands,
+                         ['command_list_ok_begin', 'setvol 64', 'status',
+                          'command_list_end'])
+
+    def test_connection_is_reused(self):
+        for volume in (10, 20, 30):
+            self.client.set_volume(volume)
+        self.client.get_volume()
+        self.assertEqual(len(self.mpd.connections), 1)
+
+    def test_reconnects_after_connection_lost(self):
+        self.client.set_volume(25)
+        self.mpd.drop_connections()
+        self.assertEqual(self.client.get_volume(), 25)
+        self.assertEqual(len(self.mpd.connections), 1)
+
+    def test_ack_raises_mpd_error(self):
+        self.assertRaises(volumed.MPDError,
+                          self.client.command_list, ['bogus'])
+        # The connection is still usable.
+        self.assertEqual(self.client.get_volume(), 50)
+
+    def test_idle_reports_mixer_changes(self):
+        fd = self.client.start_idle('mixer')
+        other = volumed.MPDClient('127.0.0.1', self.mpd.port)
+        try:
+            other.set_volume(70)
+        finally:
+            other.disconnect()
+        readable, writable, errors = select.select([fd], [], [], 2.0)
+        self.assertEqual(readable, [fd])
+        self.assertEqual(self.client.idle_changes(), {'changed': 'mixer'})
+        self.assertFalse(self.client.idling)
+
+
+class MPDOptions(test_controller.Options):
+    simulate = None
+    mpd_host = '127.0.0.1'
+
+
+class MPDVolumeTest(unittest.TestCase):
+    """Control the volume through mpd, as volumed does when moode uses
+    software volume."""
+
+    def setUp(self):
+        self.mpd = FakeMPD()
+        self.mpd.start()
+        self.dir = tempfile.mkdtemp()
+        options = MPDOptions()
+        options.db = os.path.join(self.dir, 'player.db')
+        options.mpd_port = self.mpd.port
+        connection = sqlite3.connect(options.db)
+        connection.execute("create table cfg_engine (id integer primary "
+                           "key, param char(20), value char(32))")
+        connection.executemany("insert into cfg_engine values (?, ?, ?)",
+                               FIELDS)
+        connection.execute("update cfg_engine set value = 'software' "
+                           "where param = 'mpdmixer'")
+        connection.commit()
+        connection.close()
+        # Start afresh, rather than with any other test's zones.
+        volumed.Singleton._instances.pop(volumed.VolumeZones, None)
+        self.zones = volumed.VolumeZones(options)
+
+    def tearDown(self):
+        self.zones.stop()
+        self.zones.join()
+        volumed.Singleton._instances.pop(volumed.VolumeZones, None)
+        self.mpd.stop()
+        shutil.rmtree(self.dir)
+
+    def command(self, messages):
+        client = test_controller.Client()
+        for message in messages:
+            self.zones.process_message(client, message)
+        return client
+
+    def test_set_volume(self):
+        self.assertEqual(self.command(['vol 40']).wait(1),
+                         ['Vol: 40, Mute: off'])
+        self.assertEqual(self.mpd.volume, 40)
+
+    def test_still_answers_when_mpd_stops(self):
+        self.assertEqual(self.command(['vol 40']).wait(1),
+                         ['Vol: 40, Mute: off'])
+        self.mpd.stop()
+        client = self.command(['vol 45', 'vol'])
+        time.sleep(volumed.VolumeController.MIXER_RETRY_DELAY * 2)
+        self.assertEqual(self.command(['vol']).wait(1)[:1],
+                         ['Vol: 45, Mute: off'])
+        self.assertEqual(client.wait(1)[:1], ['Vol: 45, Mute: off'])
+        for controller in self.zones.controllers.values():
+            self.assertTrue(controller.is_alive())
+            self.assertTrue(controller.monitor.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
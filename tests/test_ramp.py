@@ -0,0 +1,92 @@
+#
+# Tests for volumed's rate limited volume ramp, fades and sleep timer.
+#
+# Run from the top of the repository with:
+#   python -m unittest discover tests
+#
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'www'))
+import unittest
+
+from volumed import VolumeRamp
+
+
+class VolumeRampTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ramp = VolumeRamp(10)      # A write every 0.1s at most
+
+    def write(self, now):
+        level = self.ramp.next_level(now)
+        if level is not None:
+            self.ramp.written(level, now)
+        return level
+
+    def test_target_is_written_at_once(self):
+        self.ramp.set_target(40)
+        self.assertEqual(self.write(100.0), 40)
+        self.assertTrue(self.ramp.idle())
+        self.assertEqual(self.ramp.delay(100.0), None)
+
+    def test_writes_are_rate_limited(self):
+        self.ramp.set_target(40)
+        self.write(100.0)
+        self.ramp.set_target(41)
+        self.ramp.set_target(42)
+        self.assertEqual(self.write(100.05), None)
+        self.assertAlmostEqual(self.ramp.delay(100.05), 0.05)
+        # Only the most recent target is written.
+        self.assertEqual(self.write(100.1), 42)
+        self.assertEqual(self.write(100.2), None)
+
+    def test_force_ignores_rate_limit(self):
+        self.ramp.set_target(40)
+        self.write(100.0)
+        self.ramp.set_target(20)
+        self.assertEqual(self.ramp.next_level(100.01, True), 20)
+
+    def test_fade(self):
+        self.ramp.start_fade(50, 40, 1.0, 100.0)
+        levels = []
+        now = 100.0
+        while not self.ramp.idle():
+            # Step just past each due time, as a real clock would.
+            now += self.ramp.delay(now) + 0.001
+            level = self.write(now)
+            if level is not None:
+                levels.append(level)
+        self.assertEqual(levels, range(49, 39, -1))
+        self.assertAlmostEqual(now, 101.0, 1)
+
+    def test_fade_is_rate_limited(self):
+        self.ramp.start_fade(0, 100, 1.0, 100.0)
+        writes = 0
+        now = 100.0
+        while not self.ramp.idle():
+            now += self.ramp.delay(now) + 0.001
+            if self.write(now) is not None:
+                writes += 1
+        self.assertTrue(writes <= 11)
+        self.assertEqual(self.ramp.level, 100)
+
+    def test_target_cancels_fade(self):
+        self.ramp.start_fade(50, 0, 10.0, 100.0)
+        self.ramp.set_target(70)
+        self.assertEqual(self.write(100.0), 70)
+        self.assertTrue(self.ramp.idle())
+
+    def test_instant_fade(self):
+        self.ramp.start_fade(50, 30, 0, 100.0)
+        self.assertEqual(self.write(100.0), 30)
+
+    def test_sleep_timer_delay(self):
+        self.ramp.sleep_at = 160.0
+        self.assertAlmostEqual(self.ramp.delay(100.0), 60.0)
+        self.assertEqual(self.ramp.delay(170.0), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
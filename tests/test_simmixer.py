@@ -0,0 +1,42 @@
+#
+# Tests for volumed's simulated mixer.
+#
+# Run from the top of the repository with:
+#   python -m unittest discover tests
+#
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'www'))
+import unittest
+
+import gevent
+
+import volumed
+
+
+class SimMixerTest(unittest.TestCase):
+
+    def test_faults_on_demand(self):
+        mixer = volumed.SimMixer(0, '')
+        try:
+            mixer.inject('error')
+            self.assertRaises(volumed.MixerError, mixer.get_volume, 'PCM')
+            self.assertEqual(mixer.get_volume('PCM'), (207, False))
+        finally:
+            mixer.close()
+
+    def test_close_stops_changes(self):
+        mixer = volumed.SimMixer(0, 'changes=0.01')
+        mixer.control('PCM')
+        gevent.sleep(0.05)
+        changer = mixer.changer
+        self.assertFalse(changer.dead)
+        mixer.close()
+        self.assertTrue(changer.dead)
+        self.assertEqual(mixer.changer, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+#
+# Tests for volumed's per-connection SocketWriter, and in particular
+# for when it evicts a client.
+#
+# Run from the top of the repository with:
+#   python -m unittest discover tests
+#
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'www'))
+import unittest
+
+import gevent
+import gevent.event
+
+import volumed
+
+
+class Connection:
+    """A client connection whose sends block until unblocked."""
+
+    def __init__(self, blocked=False):
+        self.sent = []
+        self.unblocked = gevent.event.Event()
+        if not blocked:
+            self.unblocked.set()
+
+    def send(self, msg):
+        self.unblocked.wait()
+        self.sent.append(msg)
+
+    def close_connection(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SocketWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.evicted = []
+
+    def writer(self, connection):
+        return volumed.SocketWriter(connection, self.evicted.append)
+
+    def test_burst_is_not_evicted(self):
+        # Many messages queued at once, before the writer has had a
+        # chance to run, are no sign of a slow client.
+        connection = Connection()
+        writer = self.writer(connection)
+        for i in range(20):
+            writer.put('Unknown command: "x%d"' % i, False)
+        gevent.sleep(0.01)
+        self.assertEqual(self.evicted, [])
+        self.assertEqual(len(connection.sent), 20)
+
+    def test_status_replaces_unsent_status(self):
+        connection = Connection()
+        writer = self.writer(connection)
+        writer.put('Vol: 10, Mute: off', 'default')
+        writer.put('Vol: 20, Mute: off', 'default')
+        gevent.sleep(0.01)
+        self.assertEqual(connection.sent, ['Vol: 20, Mute: off'])
+
+    def test_blocked_send_is_evicted(self):
+        connection = Connection(blocked=True)
+        writer = self.writer(connection)
+        writer.put('Vol: 10, Mute: off', 'default')
+        gevent.sleep(0.01)
+        writer.put('Vol: 20, Mute: off', 'default')
+        self.assertEqual(self.evicted, [])
+        # As if the first send had been blocked for too long.
+        writer.sending_since -= volumed.SocketWriter.SEND_TIMEOUT + 1
+        writer.put('Vol: 30, Mute: off', 'default')
+        self.assertEqual(self.evicted, [connection])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+#
+# Tests for volumec's matching of volumed's responses to the commands
+# that they answer.
+#
+# Run from the top of the repository with:
+#   python -m unittest discover tests
+#
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'www'))
+import unittest
+
+from volumec import PendingRequests
+
+
+class PendingRequestsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pending = PendingRequests()
+
+    def send(self, *cmds):
+        for cmd in cmds:
+            self.pending.sent(cmd)
+
+    def answers(self, response):
+        return [cmd for cmd, latency in self.pending.received(response)]
+
+    def test_query_matches_any_status(self):
+        self.send('vol')
+        self.assertEqual(self.answers('Vol: 12, Mute: on'), ['vol'])
+
+    def test_changes_wait_for_their_state(self):
+        # The query is answered before the unmute has been applied.
+        self.send('unmute', 'vol 20', 'vol')
+        self.assertEqual(self.answers('Vol: 20, Mute: on'),
+                         ['vol 20', 'vol'])
+        self.assertEqual(self.pending.count(), 1)
+        self.assertEqual(self.answers('Vol: 20, Mute: off'), ['unmute'])
+
+    def test_merged_changes_are_answered_together(self):
+        self.send('vol 50', 'vol 60', 'mute', 'unmute')
+        self.assertEqual(sorted(self.answers('Vol: 60, Mute: off')),
+                         ['mute', 'unmute', 'vol 50', 'vol 60'])
+
+    def test_broadcast_does_not_answer_other_changes(self):
+        self.send('watch', 'mute')
+        self.assertEqual(self.answers('Vol: 35, Mute: off'), [])
+        self.assertEqual(self.answers('Vol: 35, Mute: on'), ['mute'])
+
+    def test_zones_are_matched_separately(self):
+        self.send('vol 30', '@kitchen vol 30')
+        self.assertEqual(self.answers('Zone: kitchen, Vol: 30, Mute: off'),
+                         ['@kitchen vol 30'])
+        self.assertEqual(self.answers('Vol: 30, Mute: off'), ['vol 30'])
+
+    def test_json_stale_responses_are_ignored(self):
+        self.send('vol')
+        self.assertEqual(self.answers('{"mute":false,"seq":5,"vol":30}'),
+                         ['vol'])
+        self.send('vol 30', 'vol')
+        self.assertEqual(self.answers('{"mute":false,"seq":4,"vol":30}'), [])
+        self.assertEqual(self.answers('{"mute":false,"seq":5,"vol":30}'),
+                         ['vol 30', 'vol'])
+
+    def test_errors_match_their_commands(self):
+        self.send('x1', 'vol', 'x2')
+        self.assertEqual(
+            self.answers('{"cmd":"x1; x2","error":"unknown command"}'),
+            ['x1', 'x2'])
+        self.assertEqual(self.answers('Unknown command: "vol"'), ['vol'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -42,6 +42,7 @@ var UI = {
     knob: null,
     volumedActive: true,
     volumedLastVol: -1,
+    volumedSeq: 0,
     webSocket: null,
     webSocketTo: null,
     volControls: null,
@@ -145,24 +146,37 @@ function sendVolumedCmd(cmd, session, volknob) {
     
     //console.log("sendVoldCmd: sending message: " + cmd);
     if (UI.webSocket === null) {
-	websocket = new WebSocket('ws://moode.local:8888');
+	// The volumed-json protocol gives us json replies carrying a state
+	// sequence number, and lets us send several commands at once.
+	websocket = new WebSocket('ws://moode.local:8888', ['volumed-json']);
 	UI.webSocket = websocket;
 
 	websocket.onopen = function () {
 	    UI.volumedActive = true;
-	    websocket.send('watch\n');
+	    UI.volumedSeq = 0;
 	    if (pending) {
-		websocket.send(pending);
+		websocket.send('watch; ' + pending);
 		pending = null;
 	    }
+	    else {
+		websocket.send('watch');
+	    }
 	    open = true;
 	};
 	websocket.onmessage = function(msg){
 	    //console.log("sendVoldCmd: received message: " + msg.data);
-	    parts = msg.data.split(': ');
-	    parts2 = parts[1].split(',');
-	    vol = parts2[0];
-	    mute = parts[2];
+	    var reply = JSON.parse(msg.data);
+	    if (reply.error) {
+		console.log("sendVoldCmd: " + reply.error + ": " + reply.cmd);
+		return;
+	    }
+	    if (reply.seq < UI.volumedSeq) {
+		// A stale update: we have already seen a later state.
+		return;
+	    }
+	    UI.volumedSeq = reply.seq;
+	    vol = reply.vol;
+	    mute = reply.mute ? 'on' : 'off';
 	    
 	    setMute(session, mute);
 	    session.json['volknob'] = vol;
@@ -0,0 +1,370 @@
+#! /usr/bin/env python
+#
+# This Program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 3, as
+# published by the Free Software Foundation.
+#
+# This Program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TsunAMP; see the file COPYING.  If not, see
+# <http://www.gnu.org/licenses/>.
+#
+# Volume Control Daemon   (c) 2017 Marc Munro
+#
+# Built for Moode audio player.
+#
+# This is a load generator and latency benchmark for volumed.  It starts
+# volumed (by default in emulate mode, on a port of its own), connects a
+# number of watching websocket clients and a number of driving clients,
+# and has the drivers send streams of commands like those from dragging
+# a volume knob or holding down a remote's volume button.  It reports,
+# as json:
+#
+# - command-to-response latency, as seen by the drivers;
+# - change-to-broadcast latency, the time from a driver sending a
+#   command to a watcher being told of the resulting state;
+# - throughput, and the aggregation ratio (commands per response);
+# - volumed's CPU time and memory use.
+#
+# Volumed still needs its database (db/player.db), even in emulate mode.
+# It is given a temporary copy, so that the volume and mute changes made
+# by the benchmark do not find their way into moode's settings.
+#
+
+import sys
+sys.path.append('/usr/local/lib/python2.7/site-packages')
+from ws4py.client.threadedclient import WebSocketClient
+import threading
+import time
+import os
+import re
+import json
+import socket
+import signal
+import shutil
+import subprocess
+import tempfile
+from volumec import PendingRequests
+
+
+def percentiles(values):
+    """Summarise a list of latencies (in seconds) in milliseconds."""
+    if not values:
+        return {'count': 0}
+    values = sorted(values)
+    def pct(p):
+        return round(values[min(len(values) - 1,
+                                int(len(values) * p / 100.0))] * 1000, 3)
+    return {'count': len(values),
+            'mean': round(sum(values) / len(values) * 1000, 3),
+            'p50': pct(50), 'p90': pct(90), 'p99': pct(99),
+            'max': round(values[-1] * 1000, 3)}
+
+
+class Changes:
+    """Record when each state was last asked for, so that broadcasts of
+    that state can be timed.  Only commands with a predictable outcome
+    (vol n, mute and unmute) are recorded, and relative volume changes
+    forget any recorded volumes, as the levels that they pass through
+    are not the result of those requests."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requested = {}
+
+    def request(self, key):
+        with self.lock:
+            self.requested[key] = time.time()
+
+    def forget(self, kind):
+        with self.lock:
+            for key in self.requested.keys():
+                if key[0] == kind:
+                    del self.requested[key]
+
+    def requested_at(self, key):
+        with self.lock:
+            return self.requested.get(key)
+
+
+class BenchClient(WebSocketClient):
+    """A websocket client that records the arrival of each response."""
+    status_re = re.compile("^Vol: ([0-9]+), Mute: (on|off)")
+
+    def __init__(self, url, changes):
+        WebSocketClient.__init__(self, url)
+        self.changes = changes
+        self.pending = PendingRequests()
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.broadcast_latencies = []
+        self.responses = 0
+        self.sent = 0
+        self.last = (None, None)
+        self.measured = set()
+
+    def command(self, cmd):
+        self.pending.sent(cmd)
+        self.sent += 1
+        self.send(cmd)
+
+    def received_message(self, m):
+        now = time.time()
+        response = m.data.strip()
+        with self.lock:
+            self.responses += 1
+            self.latencies.extend(
+                [latency for cmd, latency in self.pending.received(response)])
+            match = self.status_re.match(response)
+            if not match:
+                return
+            vol, mute = int(match.group(1)), match.group(2) == 'on'
+            if vol != self.last[0]:
+                self.broadcast(('vol', vol), now)
+            if mute != self.last[1]:
+                self.broadcast(('mute', mute), now)
+            self.last = (vol, mute)
+
+    def broadcast(self, key, now):
+        # Time only the first broadcast of each requested state.
+        requested = self.changes.requested_at(key)
+        if requested is not None and (key, requested) not in self.measured:
+            self.measured.add((key, requested))
+            self.broadcast_latencies.append(now - requested)
+
+
+class Driver(threading.Thread):
+    """Send a stream of commands: bursts of vol +1 or vol -1 (as from a
+    held remote button), sweeps of vol n (as from dragging the knob), and
+    mute toggles.  Each pattern is run for its share of rounds."""
+
+    def __init__(self, client, changes, options, first_level):
+        super(Driver, self).__init__()
+        self.daemon = True
+        self.client = client
+        self.changes = changes
+        self.options = options
+        self.level = first_level
+        self.muted = False
+
+    def pause(self):
+        if self.options.interval:
+            time.sleep(self.options.interval / 1000.0)
+
+    def burst(self, round):
+        step = '+1' if round % 2 == 0 else '-1'
+        self.changes.forget('vol')
+        for i in range(self.options.burst):
+            self.client.command("vol %s" % step)
+            if self.options.gap:
+                time.sleep(self.options.gap / 1000.0)
+
+    def sweep(self, round):
+        for i in range(self.options.burst):
+            self.level = 20 + (self.level - 19) % 60
+            self.changes.request(('vol', self.level))
+            self.client.command("vol %d" % self.level)
+            if self.options.gap:
+                time.sleep(self.options.gap / 1000.0)
+
+    def mute(self, round):
+        self.muted = not self.muted
+        self.changes.request(('mute', self.muted))
+        self.client.command("mute" if self.muted else "unmute")
+
+    def run(self):
+        patterns = [getattr(self, name) for name in self.options.patterns]
+        for round in range(self.options.rounds):
+            patterns[round % len(patterns)](round)
+            self.pause()
+        # Leave volumed unmuted.
+        if self.muted:
+            self.client.command("unmute")
+
+
+def wait_for_port(port, timeout):
+    limit = time.time() + timeout
+    while time.time() < limit:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.5).close()
+            return True
+        except socket.error:
+            time.sleep(0.05)
+    return False
+
+
+def process_usage(pid):
+    """Return the CPU time (in seconds) and memory use (in kB) of a
+    process, from /proc."""
+    with open("/proc/%d/stat" % pid) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    ticks = float(os.sysconf('SC_CLK_TCK'))
+    usage = {'cpu_user': int(fields[11]) / ticks,
+             'cpu_system': int(fields[12]) / ticks}
+    with open("/proc/%d/status" % pid) as f:
+        for line in f:
+            name, value = line.split(':', 1)
+            if name in ('VmRSS', 'VmHWM'):
+                usage[name.lower() + '_kb'] = int(value.split()[0])
+    return usage
+
+
+def copy_db(directory):
+    """Return the path of a temporary copy of the database that volumed,
+    run from directory, would use."""
+    fd, path = tempfile.mkstemp(prefix='player-', suffix='.db')
+    os.close(fd)
+    shutil.copyfile(os.path.join(directory, 'db', 'player.db'), path)
+    return path
+
+
+def run_benchmark(options):
+    volumed = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])),
+                           'volumed.py')
+    db = copy_db(os.path.dirname(volumed))
+    args = [sys.executable, './volumed.py', '--port', str(options.port),
+            '--socket', '', '--state-file', '', '--db', db]
+    if options.hardware:
+        args += options.volumed_args
+    else:
+        args += ['--emulate'] + options.volumed_args
+    log = open(options.log, 'w') if options.log else open(os.devnull, 'w')
+    daemon = subprocess.Popen(args, cwd=os.path.dirname(volumed),
+                              stdout=log, stderr=subprocess.STDOUT)
+    try:
+        if not wait_for_port(options.port, 10):
+            raise RuntimeError("volumed did not start listening on port %d" %
+                               options.port)
+        return drive(options, daemon.pid)
+    finally:
+        if daemon.poll() is None:
+            daemon.send_signal(signal.SIGTERM)
+            daemon.wait()
+        os.remove(db)
+
+
+def drive(options, pid):
+    url = 'ws://127.0.0.1:%d' % options.port
+    changes = Changes()
+    watchers = []
+    for i in range(options.watchers):
+        watcher = BenchClient(url, changes)
+        watcher.connect()
+        watcher.command('watch')
+        watchers.append(watcher)
+    drivers = []
+    for i in range(options.drivers):
+        client = BenchClient(url, changes)
+        client.connect()
+        drivers.append(client)
+    time.sleep(0.2)
+    before = process_usage(pid)
+    start = time.time()
+    threads = [Driver(client, changes, options, 20 + i * 7)
+               for i, client in enumerate(drivers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Wait for the last responses to arrive.
+    limit = time.time() + options.timeout
+    while (time.time() < limit and
+           any([client.pending.count() for client in drivers])):
+        time.sleep(0.01)
+    elapsed = time.time() - start
+    time.sleep(0.2)
+    after = process_usage(pid)
+    for client in watchers + drivers:
+        client.close()
+
+    sent = sum([client.sent for client in drivers])
+    responses = sum([client.responses for client in drivers])
+    latencies = sum([client.latencies for client in drivers], [])
+    broadcasts = sum([client.broadcast_latencies for client in watchers], [])
+    return {
+        'config': {'watchers': options.watchers, 'drivers': options.drivers,
+                   'rounds': options.rounds, 'burst': options.burst,
+                   'gap_ms': options.gap, 'interval_ms': options.interval,
+                   'patterns': options.patterns,
+                   'emulate': not options.hardware,
+                   'volumed_args': options.volumed_args},
+        'elapsed_s': round(elapsed, 3),
+        'commands': sent,
+        'responses': responses,
+        'unanswered': sum([client.pending.count() for client in drivers]),
+        'throughput_cmds_per_s': round(sent / elapsed, 1) if elapsed else None,
+        'aggregation_ratio': (round(float(sent) / responses, 3)
+                              if responses else None),
+        'watcher_updates': sum([client.responses for client in watchers]),
+        'command_latency_ms': percentiles(latencies),
+        'broadcast_latency_ms': percentiles(broadcasts),
+        'volumed': {
+            'cpu_user_s': round(after['cpu_user'] - before['cpu_user'], 3),
+            'cpu_system_s': round(after['cpu_system'] -
+                                  before['cpu_system'], 3),
+            'rss_kb': after.get('vmrss_kb'),
+            'peak_rss_kb': after.get('vmhwm_kb')}}
+
+
+if __name__ == '__main__':
+    import optparse
+
+    parser = optparse.OptionParser(
+        usage="%prog [options] [-- volumed options]")
+    parser.add_option("-p", "--port", type=int, dest="port", default=8898,
+                      help="Run volumed on this port (default 8898)")
+    parser.add_option("-w", "--watchers", type=int, dest="watchers",
+                      default=4,
+                      help="Number of watching clients (default 4)")
+    parser.add_option("-c", "--drivers", type=int, dest="drivers", default=1,
+                      help="Number of clients sending commands (default 1)")
+    parser.add_option("-r", "--rounds", type=int, dest="rounds", default=60,
+                      help="Number of bursts, sweeps or mute toggles " +
+                      "per driver (default 60)")
+    parser.add_option("-b", "--burst", type=int, dest="burst", default=10,
+                      help="Commands in each burst or sweep (default 10)")
+    parser.add_option("-g", "--gap", type=float, dest="gap", default=5.0,
+                      help="Milliseconds between commands in a burst " +
+                      "(default 5)")
+    parser.add_option("-i", "--interval", type=float, dest="interval",
+                      default=50.0,
+                      help="Milliseconds between rounds (default 50)")
+    parser.add_option("-P", "--patterns", dest="patterns",
+                      default='burst,sweep,mute',
+                      help="Comma separated patterns to cycle through: " +
+                      "burst, sweep and mute (default all)")
+    parser.add_option("-H", "--hardware", dest="hardware",
+                      action="store_true",
+                      help="Do not run volumed in emulate mode")
+    parser.add_option("-t", "--timeout", type=float, dest="timeout",
+                      default=5.0,
+                      help="Seconds to wait for outstanding responses " +
+                      "(default 5)")
+    parser.add_option("-l", "--log", dest="log",
+                      help="Write volumed's output to this file")
+    parser.add_option("-o", "--output", dest="output",
+                      help="Write results to this file rather than stdout")
+
+    (options, args) = parser.parse_args()
+    options.volumed_args = args
+    options.patterns = [name.strip() for name in options.patterns.split(',')]
+    for name in options.patterns:
+        if name not in ('burst', 'sweep', 'mute'):
+            sys.stderr.write("Unknown pattern: %s\n" % name)
+            sys.exit(2)
+
+    try:
+        results = run_benchmark(options)
+    except (RuntimeError, socket.error) as e:
+        sys.stderr.write("volumebench: %s\n" % e)
+        sys.exit(1)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print output
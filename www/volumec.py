@@ -29,40 +29,334 @@ import sys
 sys.path.append('/usr/local/lib/python2.7/site-packages')
 from ws4py.client.threadedclient import WebSocketClient
 import threading
+import socket
+import time
+import re
+import json
 
-class VolumeClient(WebSocketClient):
-    def __init__(self, instream, options, *args, **kwargs):
-        super(VolumeClient, self).__init__(*args, **kwargs)
-        self.instream = instream
+class PendingRequests:
+    """Track the commands that are awaiting a response from volumed, so
+    that many commands may be pipelined over one connection.
+
+    The protocol has no request ids, so responses are matched using
+    what they report.  A status response answers:
+      - any outstanding query (vol, fade, sleep, refresh, zone, proto)
+        or relative volume change for its zone;
+      - the last outstanding "vol N" for its zone that asked for the
+        volume it reports, and "mute" or "unmute" that asked for its
+        mute state.  Volumed merges these with earlier ones of the same
+        kind (only the last takes effect), so those are answered too.
+    A "vol N" or mute change is not answered by a response that does
+    not report what it asked for, as volumed may answer a connection's
+    queries, and its mute changes, before writing its volume changes,
+    and watchers are sent every change.  So a volume beyond the zone's
+    maximum, or one overridden by another client's in the same batch,
+    goes unanswered.  In the json protocol, a response whose seq is
+    lower than the highest seen for its zone when a command was sent
+    predates the command, and so does not answer it.
+
+    Unrecognised (or refused) commands are answered by an "Unknown
+    command" response quoting the command, those sent together sharing
+    one message of several lines (or in the json protocol, an error
+    response separating them with semicolons).  Watch and quit get no
+    response of their own and so are not tracked."""
+
+    status_re = re.compile(
+        "^ *(@(\\S+) +)?(vol|(un)?mute|fade|sleep|refresh|zone|"
+        "proto(col)?)\\b", re.IGNORECASE)
+    set_re = re.compile("^ *(@\\S+ +)?vol *([0-9]+) *$", re.IGNORECASE)
+    mute_re = re.compile("^ *(@\\S+ +)?(un)?mute *$", re.IGNORECASE)
+    zone_re = re.compile("^ *zone +(\\S+) *$", re.IGNORECASE)
+    status_response_re = re.compile(
+        "^(Zone: ([^,]*), )?Vol: ([0-9]+), Mute: (on|off)")
+    untracked_re = re.compile("^ *(watch|q(uit)?) *$", re.IGNORECASE)
+    unknown_re = re.compile('^(Unknown command|Rate limited): "(.*)"$')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.outstanding = []
+        self.zone = 'default'
+        self.seqs = {}
+
+    def sent(self, cmd):
+        cmd = cmd.strip()
+        if self.untracked_re.match(cmd):
+            return
+        zone, expect = None, None
+        match = self.status_re.match(cmd)
+        if match:
+            match_zone = self.zone_re.match(cmd)
+            if match_zone:
+                self.zone = match_zone.group(1)
+            zone = match.group(2) or self.zone
+            match = self.set_re.match(cmd)
+            if match:
+                expect = ('vol', int(match.group(2)))
+            match = self.mute_re.match(cmd)
+            if match:
+                expect = ('mute', not match.group(2))
+        with self.lock:
+            self.outstanding.append((cmd, time.time(), zone, expect,
+                                     self.seqs.get(zone)))
+
+    def parse(self, response):
+        """Return the (zone, vol, mute, seq) reported by a status
+        response, or a list of the commands refused by an error
+        response.  Otherwise return None."""
+        if response.startswith('{'):
+            try:
+                status = json.loads(response)
+            except ValueError:
+                return None
+            if 'error' in status:
+                return [cmd.strip()
+                        for cmd in status.get('cmd', '').split(';')]
+            if 'vol' in status:
+                return (status.get('zone', 'default'), status['vol'],
+                        status.get('mute'), status.get('seq'))
+            return None
+        match = self.unknown_re.match(response)
+        if match:
+            return [match.group(2)]
+        match = self.status_response_re.match(response)
+        if match:
+            return (match.group(2) or 'default', int(match.group(3)),
+                    match.group(4) == 'on', None)
+        return None
+
+    def answered(self, zone, vol, mute, seq):
+        """Return the outstanding entries that a status response
+        answers.  Called with self.lock held."""
+        entries = [entry for entry in self.outstanding
+                   if entry[2] == zone and
+                   (seq is None or entry[4] is None or seq >= entry[4])]
+        matched = [entry for entry in entries if entry[3] is None]
+        for kind, value in (('vol', vol), ('mute', mute)):
+            of_kind = [entry for entry in entries
+                       if entry[3] and entry[3][0] == kind]
+            hits = [i for i, entry in enumerate(of_kind)
+                    if entry[3][1] == value]
+            if hits:
+                matched.extend(of_kind[:hits[-1] + 1])
+        return [entry for entry in entries if entry in matched]
+
+    def received(self, response):
+        """Record a response, returning a list of (command, latency)
+        for the commands that it answers."""
+        now = time.time()
+        parsed = self.parse(response.strip())
+        with self.lock:
+            if isinstance(parsed, list):
+                matched = []
+                for cmd in parsed:
+                    matched.extend([entry for entry in self.outstanding
+                                    if entry[0] == cmd and
+                                    entry not in matched][:1])
+            elif parsed:
+                zone, vol, mute, seq = parsed
+                matched = self.answered(zone, vol, mute, seq)
+                if seq is not None:
+                    self.seqs[zone] = max(seq, self.seqs.get(zone, seq))
+            else:
+                matched = []
+            for entry in matched:
+                self.outstanding.remove(entry)
+        return [(entry[0], now - entry[1]) for entry in matched]
+
+    def count(self):
+        with self.lock:
+            return len(self.outstanding)
+
+
+class ResponseHandler:
+    """Logic shared by our websocket and unix socket clients for sending
+    commands and handling their responses.  The client provides
+    transmit() and close()."""
+
+    def init_responses(self, options):
         self.options = options
-        self.expecting_response = False
+        self.pending = PendingRequests()
+        self.latencies = []
         self._close_after_msg = False
-
-    def closed(self, code, reason=None):
-        if code != 1000:
-            print "Closed down", code, reason
+        self.timer = None
 
     def close_after_msg(self):
-        if self.expecting_response:
-            self._close_after_msg = True
-        else:
+        """Close the connection once every outstanding command has been
+        answered, or after options.timeout seconds."""
+        self._close_after_msg = True
+        if self.pending.count() == 0:
             self.close()
-            
+        elif self.options.timeout > 0:
+            self.timer = threading.Timer(self.options.timeout, self.timed_out)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def timed_out(self):
+        missing = self.pending.count()
+        if missing:
+            sys.stderr.write("volumec: No response to %d command%s\n" %
+                             (missing, "" if missing == 1 else "s"))
+        self.close()
+
     def write(self, cmd):
         self.sendcmd(cmd)
-        
+
     def sendcmd(self, cmd):
-        self.expecting_response = True
         if self.options.verbose:
             print "TX: %s" % cmd.strip()
-        self.send(cmd)
-        
-    def received_message(self, m):
+        self.pending.sent(cmd)
+        self.transmit(cmd)
+
+    def response(self, line):
         if not self.options.quiet:
-            print m.data.strip()
-        if self._close_after_msg:
+            print line.strip()
+        for cmd, latency in self.pending.received(line):
+            self.latencies.append(latency)
+            if self.options.latency:
+                sys.stderr.write("%8.2f ms  %s\n" % (latency * 1000, cmd))
+        if self._close_after_msg and self.pending.count() == 0:
             self.close()
-        self.expecting_response = False
+
+    def finish(self):
+        """Tidy up once the connection has closed, reporting a summary
+        of response times if requested."""
+        if self.timer:
+            self.timer.cancel()
+            self.timer.join()
+        if self.options.latency and self.latencies:
+            latencies = sorted(self.latencies)
+            sys.stderr.write(
+                "%d responses, min %.2f ms, median %.2f ms, max %.2f ms\n" %
+                (len(latencies), latencies[0] * 1000,
+                 latencies[len(latencies) // 2] * 1000,
+                 latencies[-1] * 1000))
+
+
+class VolumeClient(ResponseHandler, WebSocketClient):
+    def __init__(self, instream, options, *args, **kwargs):
+        WebSocketClient.__init__(self, *args, **kwargs)
+        self.instream = instream
+        self.init_responses(options)
+
+    def closed(self, code, reason=None):
+        if code != 1000:
+            print "Closed down", code, reason
+
+    def transmit(self, cmd):
+        self.send(cmd)
+
+    def received_message(self, m):
+        # Error responses to several commands come as several lines.
+        for line in m.data.splitlines():
+            self.response(line)
+
+
+class UnixVolumeClient(ResponseHandler):
+    """A client for volumed's unix domain socket.  This provides the same
+    interface as VolumeClient but avoids the websocket handshake and
+    framing, which makes it the cheaper option for local clients."""
+
+    def __init__(self, instream, options, path):
+        self.instream = instream
+        self.path = path
+        self.sock = None
+        self.done = threading.Event()
+        self.init_responses(options)
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+        self.reader = threading.Thread(target=self.read_responses)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def read_responses(self):
+        rfile = self.sock.makefile('rb')
+        try:
+            while True:
+                line = rfile.readline()
+                if not line:
+                    break
+                self.response(line)
+        except socket.error:
+            pass
+        self.done.set()
+
+    def close(self):
+        if self.sock:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        self.done.set()
+
+    def transmit(self, cmd):
+        self.sock.sendall(cmd)
+
+    def run_forever(self):
+        while not self.done.is_set():
+            self.done.wait(1.0)
+
+
+class RepeatCoalescer:
+    """Sit between a command stream and a client, merging volume deltas
+    that arrive within window seconds of the last one sent into a single
+    "vol +N" command.  The first press is sent immediately, subsequent
+    repeats at most once per window, and nothing is lost: the total
+    change sent is always the total change requested.  Any other command
+    first flushes pending deltas, so ordering is preserved."""
+
+    delta_re = re.compile("^ *vol *([+-]) *([0-9]+) *$", re.IGNORECASE)
+
+    def __init__(self, client, window):
+        self.client = client
+        self.window = window
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.last_sent = 0.0
+        self.timer = None
+
+    def send_pending(self):
+        # Called with self.lock held.
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if self.pending:
+            self.client.write("vol %+d\n" % self.pending)
+            self.pending = 0
+            self.last_sent = time.time()
+
+    def timed_flush(self):
+        with self.lock:
+            self.timer = None
+            self.send_pending()
+
+    def write(self, cmd):
+        match = self.delta_re.match(cmd)
+        with self.lock:
+            if not match:
+                self.send_pending()
+                self.client.write(cmd)
+                return
+            delta = int(match.group(2))
+            if match.group(1) == '-':
+                delta = -delta
+            if self.pending and (self.pending > 0) != (delta > 0):
+                # Direction has changed: don't let the old repeats cancel
+                # out the new press.
+                self.send_pending()
+            self.pending += delta
+            wait = self.last_sent + self.window - time.time()
+            if wait <= 0:
+                self.send_pending()
+            elif not self.timer:
+                self.timer = threading.Timer(wait, self.timed_flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            self.send_pending()
 
 
 class StreamTermination(Exception): pass
@@ -110,28 +404,41 @@ class IRCmdStream:
 
 
 class FileStream:
+    """Read commands from a file, or stdin if filename is "-".  If the
+    file is a named pipe and options.hold is set, the pipe is re-opened
+    each time its writer closes it.  A line of q or quit ends the
+    stream."""
+
     def __init__(self, filename, options):
         self.filename = filename
         self.options = options
+        if filename == '-':
+            self.reopen = False
+            self.stream = sys.stdin
+            return
         if options.hold:
             import stat, os
-            self.reopen = stat.S_ISFIFO(os.stat(options.file).st_mode)
+            self.reopen = stat.S_ISFIFO(os.stat(filename).st_mode)
         else:
             self.reopen = False
-        self.stream = open(options.file, "r")
+        self.stream = open(filename, "r")
 
     def close(self):
         self.stream.close()
 
     def readline(self):
         while True:
-            line = self.stream.readline
+            line = self.stream.readline()
             if line:
-                if (line == 'q\n') or (line == 'quit\n'):
+                if line.strip() in ('q', 'quit'):
                     return None
-                return line
-            if self.reopen:
-                self.stream = open(options.file, "r")
+                if line.strip():
+                    return line
+                continue
+            if not self.reopen:
+                return None
+            self.stream.close()
+            self.stream = open(self.filename, "r")
 
     
 if __name__ == '__main__':
@@ -143,6 +450,14 @@ if __name__ == '__main__':
                       help="Connect to volumed server using specified port")
     parser.add_option("-p", "--port", type=int, dest="port", default=8888,
                       help="Connect to volumed server using specified port")
+    parser.add_option("-u", "--unix", dest="unix", action="store_true",
+                      help="Connect using volumed's unix domain socket")
+    parser.add_option("-s", "--socket", dest="socket",
+                      default='/run/volumed.sock',
+                      help="Path of volumed's unix domain socket " +
+                      "(default /run/volumed.sock)")
+    parser.add_option("-z", "--zone", dest="zone",
+                      help="Send commands to the named volumed zone")
     parser.add_option("-c", "--command",  dest="command",
                       help="Execute the specified volumed command")
     parser.add_option("-f", "--file",  dest="file",
@@ -152,6 +467,17 @@ if __name__ == '__main__':
     parser.add_option("-d", "--lirc",  "--daemon", dest="daemon",
                       action="store_true",
                       help="Run as an lirc client (daemon)")
+    parser.add_option("-r", "--repeat-window", type=float,
+                      dest="repeat_window", default=0.1,
+                      help="In lirc mode, send repeated volume changes " +
+                      "at most once per this many seconds, merged into " +
+                      "a single change (default 0.1, 0 to disable)")
+    parser.add_option("-t", "--timeout", type=float, dest="timeout",
+                      default=5.0,
+                      help="Once input ends, wait at most this many " +
+                      "seconds for outstanding responses (default 5)")
+    parser.add_option("-l", "--latency", dest="latency", action="store_true",
+                      help="Report each command's round-trip time on stderr")
     parser.add_option("-v", "--verbose",  dest="verbose", action="store_true",
                       help="Provide verbose output")
     parser.add_option("-q", "--quiet",  dest="quiet", action="store_true",
@@ -179,9 +505,14 @@ if __name__ == '__main__':
         
     elif options.file:
         # TODO: Check for conflicting options
-        instream = open(options.file, "r")
+        try:
+            instream = FileStream(options.file, options)
+        except (IOError, OSError) as e:
+            sys.stderr.write("volumec: Unable to read %s.\n    %s\n" %
+                             (options.file, str(e)))
+            sys.exit(2)
     else:
-        instream = sys.stdin
+        instream = FileStream('-', options)
 
     sighup_received = False
     sigterm_received = False
@@ -201,9 +532,12 @@ if __name__ == '__main__':
     signal.signal(signal.SIGHUP, handleHup)
     signal.signal(signal.SIGTERM, handleTerm)
         
-    ws = VolumeClient(instream, options,
-                      'ws://%s:%d' % (options.hostname, options.port),
-                      protocols=['http-only', 'chat'])
+    if options.unix:
+        ws = UnixVolumeClient(instream, options, options.socket)
+    else:
+        ws = VolumeClient(instream, options,
+                          'ws://%s:%d' % (options.hostname, options.port),
+                          protocols=['http-only', 'chat'])
 
     try:
         ws.connect()
@@ -212,15 +546,21 @@ if __name__ == '__main__':
             ("volumec: Unable to connect with volumed.\n    %s\n" +
              "Closing down.\n") % str(e))
         sys.exit(2)
-        
+
+    if options.zone:
+        ws.write("zone %s\n" % options.zone)
+
+    sender = ws
+    if options.daemon and options.repeat_window > 0:
+        sender = RepeatCoalescer(ws, options.repeat_window)
+
     try:
         while True:
             try:
                 msg = instream.readline()
-            except StreamTermination:
-                sys.stderr.write(
-                    "volumec: Disconnected from lirc socket\n")
-
+            except StreamTermination as e:
+                sys.stderr.write(str(e))
+                break
             except Exception as e:
                 if sighup_received:
                     # Just try again
@@ -231,21 +571,26 @@ if __name__ == '__main__':
                     break
                 sys.stderr.write(
                     "volumec: Error on input\n    %s\n" % str(e))
-                os.exit(2)
+                sys.exit(2)
             if msg:
                 try:
-                    ws.write(msg.strip() + "\n")
+                    sender.write(msg.strip() + "\n")
                 except Exception:
                     sys.stderr.write(
                         "volumec: Lost contact with volumed.  Closing down.\n")
-                    ws.close
+                    ws.close()
                     sys.exit(2)
             else:
                 break
 
+        if sender is not ws:
+            sender.flush()
         ws.close_after_msg()
         ws.run_forever()
     except KeyboardInterrupt:
         ws.close()
         sys.exit(1)
+    ws.finish()
+    if ws.pending.count():
+        sys.exit(1)
 
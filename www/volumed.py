@@ -20,29 +20,41 @@
 # This provides a websocket interface for controlling the volume and
 # mute, which can greatly improve the responsiveness of a web client.
 # It also manages the update of Moode's database for volume and mute
-# status, and actively polls the hardware so that any out of band change
-# to volume/mute can be reported to clients.
+# status, and watches the hardware (through alsa mixer events or mpd's
+# idle command, or failing that by polling) so that any out of band
+# change to volume/mute can be reported to clients.
 #
 # Note that a client, volumec.py, is also provided for testing purposes
 # and for implementing shell-based interfaces, eg for IR remotes.
 #
-# TODO:
-#   - volume curve correction: see note in
-#       VolumeController.correct_volume()
-#
 
 import sys
 sys.path.append('/usr/local/lib/python2.7/site-packages')
 from gevent import monkey; monkey.patch_all()
+import gevent
+import gevent.event
+import gevent.queue
+import gevent.server
 from ws4py.websocket import WebSocket
 from ws4py.server.geventserver import WSGIServer
 from ws4py.server.wsgiutils import WebSocketWSGIApplication
+from ws4py.client.threadedclient import WebSocketClient
 
 import threading
 import time
 import sys
 import re
-import Queue
+import json
+import math
+import random
+import bisect
+import collections
+import itertools
+import errno
+import fcntl
+import os
+import select
+import socket
 import sqlite3
 import subprocess
 
@@ -62,21 +74,26 @@ class Singleton(object):
 
 class ThreadPlus(threading.Thread):
     """Thread with added stop, sleep and sleep-target manipulation
-    methods."""
-    RESOLUTION = 0.3
+    methods.  As threading is monkey-patched, our threads are really
+    greenlets sharing gevent's single event loop.  None of them poll:
+    each blocks on a gevent event, queue or select until it has work to
+    do, a timer expires, or it is stopped."""
 
     def __init__(self):
         super(ThreadPlus, self).__init__()
         self.running = True
         self.sleep_target = 0
         self.target_lock = threading.Lock()
+        self.wakeup = gevent.event.Event()
 
     def stop(self):
         self.running = False
+        self.wakeup.set()
 
     def set_sleep_target(self, target_time):
         with self.target_lock:
             self.sleep_target = target_time
+        self.wakeup.set()
         
     def target(self):
         with self.target_lock:
@@ -87,26 +104,1077 @@ class ThreadPlus(threading.Thread):
         Return True if we are still running (ie we reached our timeout).
         Note that the timeout may have been modified while we slept.  If
         so, we will only return True if we reach the modified timeout."""
-        now = time.time()
-        self.set_sleep_target(now + sleep_time)
+        self.set_sleep_target(time.time() + sleep_time)
         
         while self.running:
             # sys.stdout.flush() # Uncomment when tee-ing the output for debug
-            tick = min(now + ThreadPlus.RESOLUTION, self.target())
-            time.sleep(tick - now)
-            now = time.time()
-            if now >= self.target():
+            self.wakeup.clear()
+            remaining = self.target() - time.time()
+            if remaining <= 0:
                 return True
+            self.wakeup.wait(remaining)
             
+class Histogram:
+    """A histogram with fixed buckets, in the style of Prometheus.
+    Observing a value is a bisect and a couple of increments, so these
+    are cheap enough to leave on permanently."""
+    LATENCY_BUCKETS = [0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                       0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0]
+
+    def __init__(self, buckets=None):
+        self.buckets = buckets or Histogram.LATENCY_BUCKETS
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ['+Inf'], self.counts):
+            cumulative += count
+            lines.append('%s_bucket%s %d' %
+                         (name, format_labels(labels + [('le', bound)]),
+                          cumulative))
+        lines.append('%s_sum%s %s' % (name, format_labels(labels),
+                                      repr(float(self.sum))))
+        lines.append('%s_count%s %d' % (name, format_labels(labels),
+                                        self.count))
+        return lines
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (name, value)
+                              for name, value in labels])
+
+
+class Metrics:
+    """Counters, gauges and histograms describing volumed's operation,
+    rendered in the Prometheus text format for the /metrics endpoint.
+    Each metric may have several series, distinguished by labels (given
+    as a tuple of (name, value) pairs)."""
+
+    HELP = {
+        'volumed_hw_call_seconds': ('histogram',
+                                    'Duration of mixer and mpd calls'),
+        'volumed_db_load_seconds': ('histogram',
+                                    'Duration of database reads'),
+        'volumed_db_commit_seconds': ('histogram',
+                                      'Duration of database commits'),
+        'volumed_queue_wait_seconds': ('histogram',
+                                       'Time commands spend queued'),
+        'volumed_command_seconds': ('histogram',
+                                    'Time from receiving a command to '
+                                    'queueing its response'),
+        'volumed_batch_size': ('histogram',
+                               'Number of commands processed together'),
+        'volumed_commands_total': ('counter', 'Commands received'),
+        'volumed_commands_rejected_total': ('counter',
+                                            'Commands refused by '
+                                            'admission control'),
+        'volumed_commands_merged_total': ('counter',
+                                          'Commands merged into an '
+                                          'already queued command'),
+        'volumed_commands_preempted_total': ('counter',
+                                             'Commands handled without '
+                                             'being queued, by lane'),
+        'volumed_send_failures_total': ('counter',
+                                        'Failed sends to clients'),
+        'volumed_evictions_total': ('counter',
+                                    'Clients evicted for falling behind'),
+        'volumed_external_changes_total': ('counter',
+                                           'Volume or mute changes made '
+                                           'by others'),
+        'volumed_mixer_errors_total': ('counter', 'Mixer failures'),
+        'volumed_watchers': ('gauge', 'Clients watching for changes'),
+        'volumed_connections': ('gauge', 'Connected clients'),
+        'volumed_first_response_seconds': ('gauge',
+                                           'Time from process start to '
+                                           'the first response sent'),
+    }
+    BATCH_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128]
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def observe(self, name, value, labels=()):
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if not histogram:
+            histogram = Histogram(Metrics.BATCH_BUCKETS
+                                  if name == 'volumed_batch_size' else None)
+            self.histograms[key] = histogram
+        histogram.observe(value)
+
+    def count(self, name, labels=(), increment=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + increment
+
+    def gauge(self, name, function):
+        """Register a function returning a list of (labels, value) pairs,
+        to be called when rendering."""
+        self.gauges[name] = function
+
+    def render(self):
+        series = {}
+        for (name, labels), histogram in self.histograms.items():
+            series.setdefault(name, []).extend(
+                histogram.render(name, list(labels)))
+        for (name, labels), value in self.counters.items():
+            series.setdefault(name, []).append(
+                '%s%s %d' % (name, format_labels(list(labels)), value))
+        for name, function in self.gauges.items():
+            for labels, value in function():
+                series.setdefault(name, []).append(
+                    '%s%s %s' % (name, format_labels(list(labels)), value))
+        lines = []
+        for name in sorted(series):
+            kind, help = Metrics.HELP[name]
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            lines.extend(series[name])
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+
+
+def timed(op):
+    """Decorate a hardware interface method, recording its duration."""
+    def decorate(method):
+        def timed_method(*args):
+            start = time.time()
+            try:
+                return method(*args)
+            finally:
+                METRICS.observe('volumed_hw_call_seconds',
+                                time.time() - start, (('op', op),))
+        return timed_method
+    return decorate
+
+
+def process_start_time():
+    """Return the time at which this process started, from /proc, so
+    that the interpreter's own start-up is included; or, failing that,
+    the time now."""
+    try:
+        with open('/proc/self/stat') as f:
+            ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return (time.time() - uptime +
+                ticks / float(os.sysconf('SC_CLK_TCK')))
+    except (IOError, OSError, ValueError, IndexError):
+        return time.time()
+
+
+class StartupTimer:
+    """Measure our time to first response: from the start of the
+    process to the first message successfully sent to a client.  This
+    is reported as a metric, and printed when debugging."""
+
+    def __init__(self):
+        self.started = process_start_time()
+        self.first_response = None
+        METRICS.gauge('volumed_first_response_seconds', self.metric)
+
+    def responded(self):
+        if self.first_response is None:
+            self.first_response = time.time() - self.started
+            if DEBUG:
+                print "First response sent %.1f ms after start" % (
+                    self.first_response * 1000)
+
+    def metric(self):
+        if self.first_response is None:
+            return []
+        return [((), round(self.first_response, 6))]
+
+
+STARTUP = StartupTimer()
+
+
+class Trace:
+    """The progress of one command through volumed, as a list of
+    (event, time, detail) tuples."""
+
+    def __init__(self, id):
+        self.id = id
+        self.events = []
+
+    def mark(self, event, detail=None):
+        self.events.append((event, time.time(), detail))
+
+    def as_dict(self):
+        """Return the trace for dumping, with event times given in
+        milliseconds since the command was received."""
+        start = self.events[0][1] if self.events else 0
+        events = []
+        for event, when, detail in self.events:
+            entry = [event, round((when - start) * 1000, 3)]
+            if detail is not None:
+                entry.append(detail)
+            events.append(entry)
+        return {'id': self.id, 'start': start, 'events': events}
+
+
+class Tracer:
+    """Sampled tracing of commands, from the arrival of their message,
+    through parsing, queueing, batching, hardware calls and database
+    updates, to each socket send.  A fraction (rate) of messages are
+    traced, and the most recent traces are kept in a ring buffer of the
+    given size, to be dumped on SIGUSR1 or by the trace command.  When
+    a json message holds several commands, each gets a trace of its
+    own, with an id derived from that of the message."""
+
+    def __init__(self, rate=0.0, size=256):
+        self.configure(rate, size)
+        self.ids = itertools.count(1)
+
+    def configure(self, rate, size):
+        self.rate = rate
+        self.traces = collections.deque(maxlen=size)
+
+    def start(self):
+        """Return a new trace for a message just received, or None if
+        the message is not to be traced."""
+        if not self.rate or random.random() >= self.rate:
+            return None
+        trace = Trace(str(next(self.ids)))
+        trace.mark('received')
+        self.traces.append(trace)
+        return trace
+
+    def split(self, trace, count):
+        """Replace trace with one trace for each of count commands."""
+        if not trace or count == 1:
+            return [trace] * count
+        try:
+            self.traces.remove(trace)
+        except ValueError:
+            pass
+        traces = []
+        for i in range(count):
+            child = Trace("%s.%d" % (trace.id, i + 1))
+            child.events = list(trace.events)
+            self.traces.append(child)
+            traces.append(child)
+        return traces
+
+    def dump(self):
+        return [trace.as_dict() for trace in list(self.traces)]
+
+
+TRACER = Tracer()
+
+
+class Recorder:
+    """Record the traffic that we receive, for replaying with
+    volumereplay.py.  Each connection is given an id, and its opening,
+    each message received on it and its closing are written as json
+    lines with a timestamp (from time.time()), eg:
+      {"conn": 3, "event": "open", "protocol": "json", "t": 1509...,
+       "transport": "ws", "zone": null}
+      {"conn": 3, "msg": "vol +1", "t": 1509...}
+      {"conn": 3, "event": "close", "t": 1509...}
+    Until a file is opened, nothing is recorded."""
+
+    def __init__(self):
+        self.file = None
+        self.ids = itertools.count(1)
+
+    def open(self, path):
+        self.file = open(path, 'a', 1)
+
+    def write(self, socket, entry):
+        entry['t'] = time.time()
+        entry['conn'] = socket.record_id
+        try:
+            self.file.write(json.dumps(entry, sort_keys=True) + "\n")
+        except IOError as e:
+            sys.stderr.write("Unable to record traffic: %s\n" % e)
+            self.file = None
+
+    def opened(self, socket, transport):
+        socket.record_id = next(self.ids)
+        if self.file:
+            self.write(socket, {'event': 'open', 'transport': transport,
+                                'protocol': socket.protocol,
+                                'zone': socket.zone})
+
+    def received(self, socket, message):
+        if self.file:
+            self.write(socket, {'msg': message})
+
+    def closed(self, socket):
+        if self.file:
+            self.write(socket, {'event': 'close'})
+
+
+RECORDER = Recorder()
+
+
+class MixerError(Exception): pass
+
+class MPDError(MixerError): pass
+
+class MPDClient:
+    """A minimal client for mpd's text protocol.  This holds a single
+    long-lived connection to mpd, so that we do not have to fork mpc for
+    each volume read or write.  If the connection is lost, it will be
+    re-established on the next command.  The host may be a hostname or
+    the path of mpd's unix domain socket."""
+
+    def __init__(self, host='localhost', port=6600, timeout=5.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sock = None
+        self.rfile = None
+        self.idling = False
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.host.startswith('/'):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.host)
+        else:
+            sock = socket.create_connection((self.host, self.port),
+                                            self.timeout)
+        rfile = sock.makefile('rb')
+        hello = rfile.readline()
+        if not hello.startswith('OK MPD '):
+            sock.close()
+            raise MPDError("Unexpected greeting from mpd: \"%s\"" %
+                           hello.strip())
+        self.sock, self.rfile = sock, rfile
+
+    def disconnect(self):
+        if self.sock:
+            try:
+                self.rfile.close()
+                self.sock.close()
+            except Exception:
+                pass
+        self.sock, self.rfile = None, None
+        self.idling = False
+
+    def read_line(self):
+        line = self.rfile.readline()
+        if not line:
+            raise socket.error("Connection closed by mpd")
+        return line.rstrip('\n')
+
+    def read_response(self, terminators):
+        """Read key: value pairs up to one of the terminator lines,
+        returning them as a dict.  An ACK response raises MPDError.  The
+        connection remains usable after an ACK."""
+        result = {}
+        while True:
+            line = self.read_line()
+            if line in terminators:
+                return result
+            if line.startswith('ACK '):
+                raise MPDError(line)
+            key, sep, value = line.partition(': ')
+            result[key] = value
+
+    def execute(self, commands):
+        # Send the commands as a single command list so that they are
+        # pipelined into one write and one round trip.
+        if len(commands) == 1:
+            self.sock.sendall(commands[0] + '\n')
+            return [self.read_response(('OK',))]
+        self.sock.sendall('command_list_ok_begin\n' +
+                          ''.join([cmd + '\n' for cmd in commands]) +
+                          'command_list_end\n')
+        results = [self.read_response(('list_OK',)) for cmd in commands]
+        self.read_response(('OK',))
+        return results
+
+    def command_list(self, commands):
+        """Run a list of commands, returning a list of response dicts,
+        one per command.  If our connection has gone away we make one
+        attempt to reconnect before giving up."""
+        with self.lock:
+            for attempt in (1, 2):
+                try:
+                    if not self.sock:
+                        self.connect()
+                    return self.execute(commands)
+                except (socket.error, EOFError):
+                    self.disconnect()
+                    if attempt == 2:
+                        raise
+
+    def status(self):
+        return self.command_list(['status'])[0]
+
+    def get_volume(self):
+        return int(self.status()['volume'])
+
+    def set_volume(self, volume):
+        """Set the volume, returning the volume reported by mpd
+        afterwards."""
+        results = self.command_list(['setvol %d' % volume, 'status'])
+        return int(results[1]['volume'])
+
+    def start_idle(self, subsystems):
+        """Ask mpd to notify us of changes to the given subsystems,
+        unless we have already done so, and return the file descriptor
+        on which the notification will arrive.  Once that is readable,
+        idle_changes() must be called.  Since an idling connection can
+        be used for nothing else, this should be used on a connection
+        dedicated to the purpose."""
+        with self.lock:
+            if not self.idling:
+                try:
+                    if not self.sock:
+                        self.connect()
+                    self.sock.sendall('idle %s\n' % subsystems)
+                except socket.error:
+                    self.disconnect()
+                    raise
+                self.idling = True
+            return self.sock.fileno()
+
+    def idle_changes(self):
+        with self.lock:
+            self.idling = False
+            try:
+                return self.read_response(('OK',))
+            except (socket.error, EOFError):
+                self.disconnect()
+                raise
+
+
+class VolumeCurve:
+    """Lookup tables mapping volume percentages to raw mixer values and
+    back.  A curve is built once for a given mixer range and curve
+    setting, after which each conversion is a simple lookup.
+
+    Provided that the mixer range has at least 101 values, each
+    percentage is given its own raw value, so that:
+      curve.to_pct(curve.to_raw(pct)) == pct
+    and, for any raw value that to_raw() can return:
+      curve.to_raw(curve.to_pct(raw)) == raw
+    Other raw values (eg set by alsamixer) map to the percentage with
+    the nearest raw value."""
+
+    def __init__(self, raw_min, raw_max, targets):
+        """Targets gives the ideal, possibly fractional, raw value for
+        each percentage from 0 to 100."""
+        self.raw_min, self.raw_max = raw_min, raw_max
+        forward = []
+        for target in targets:
+            raw = min(max(int(math.floor(target + 0.5)), raw_min), raw_max)
+            forward.append(max([raw] + forward[-1:]))
+        if raw_max - raw_min >= 100:
+            # Spread out any percentages that share a raw value, first
+            # upwards and then, for those squashed against raw_max,
+            # downwards.  With a smaller range this is impossible, and
+            # the round-trip guarantees cannot be met.
+            for pct in range(1, 101):
+                if forward[pct] <= forward[pct - 1]:
+                    forward[pct] = min(forward[pct - 1] + 1, raw_max)
+            for pct in range(99, -1, -1):
+                if forward[pct] >= forward[pct + 1]:
+                    forward[pct] = max(forward[pct + 1] - 1, raw_min)
+        self.forward = forward
+        self.inverse = {}
+        for pct in range(100, -1, -1):
+            self.inverse[forward[pct]] = pct
+
+    @classmethod
+    def linear(class_, raw_min, raw_max):
+        return class_(raw_min, raw_max,
+                      [raw_min + (raw_max - raw_min) * pct / 100.0
+                       for pct in range(101)])
+
+    @classmethod
+    def logarithmic(class_, raw_min, raw_max, factor):
+        """Moode's logarithmic curve, as applied by playerlib.js:
+          hw_pct = a * log10(pct) - 2a + 100
+        where a is the volcurvefac setting."""
+        targets = []
+        for pct in range(101):
+            if pct > 1:
+                hw_pct = factor * math.log10(pct) - 2 * factor + 100
+                hw_pct = min(max(hw_pct, 0), 100)
+            else:
+                hw_pct = pct
+            targets.append(raw_min + (raw_max - raw_min) * hw_pct / 100.0)
+        return class_(raw_min, raw_max, targets)
+
+    @classmethod
+    def db_linear(class_, raw_min, raw_max, db_min, db_max, db_to_raw):
+        """A curve that is linear in dB (in units of 1/100 dB) from db_min
+        at 1% to db_max at 100%.  0% is always raw_min."""
+        targets = [raw_min]
+        for pct in range(1, 101):
+            db = db_min + (db_max - db_min) * (pct - 1) / 99.0
+            targets.append(db_to_raw(int(math.floor(db + 0.5))))
+        return class_(raw_min, raw_max, targets)
+
+    def to_raw(self, pct):
+        return self.forward[min(max(int(pct), 0), 100)]
+
+    def to_pct(self, raw):
+        pct = self.inverse.get(raw)
+        if pct is None:
+            pct = bisect.bisect_left(self.forward, raw)
+            if pct > 100:
+                pct = 100
+            elif pct > 0 and (raw - self.forward[pct - 1] <=
+                              self.forward[pct] - raw):
+                pct -= 1
+        return pct
+
+
+class AmixerMixer:
+    """Control an alsa mixer element by running amixer and parsing its
+    output.  This is the fallback for when libasound cannot be used
+    directly."""
+
+    def __init__(self, cardnum):
+        self.cardnum = cardnum
+        self.limits_re = re.compile("Limits:[^0-9-]*(-?[0-9]+) - (-?[0-9]+)")
+        self.volume_re = re.compile(
+          ": Playback (-?[0-9]+) \[[0-9]+%\](.*\[(on|off)\])?")
+        self.ranges = {}
+
+    def event_fds(self):
+        """We have no means of discovering changes other than polling."""
+        return None
+
+    def amixer(self, *args):
+        try:
+            return subprocess.check_output(
+                ["amixer", "-c", str(self.cardnum)] + list(args))
+        except (subprocess.CalledProcessError, OSError) as e:
+            raise MixerError("amixer failed: %s" % e)
+
+    def sget(self, control):
+        out = self.amixer("sget", control)
+        if control not in self.ranges:
+            match = self.limits_re.search(out)
+            if not match:
+                raise MixerError("Unable to parse amixer limits for %s" %
+                                 control)
+            self.ranges[control] = (int(match.group(1)),
+                                    int(match.group(2)))
+        return out
+
+    def get_range(self, control):
+        if control not in self.ranges:
+            self.sget(control)
+        return self.ranges[control]
+
+    def db_range(self, control):
+        """We cannot cheaply map between dB and raw values using
+        amixer, so we do not support dB-based curves."""
+        return None
+
+    def get_volume(self, control):
+        match = self.volume_re.search(self.sget(control))
+        if not match:
+            raise MixerError("Unable to parse amixer volume for %s" %
+                             control)
+        return int(match.group(1)), match.group(3) == 'off'
+
+    def set_mute(self, control, mute):
+        self.amixer("sset", control, 'mute' if mute else 'unmute')
+
+    def set_volume(self, control, raw):
+        self.amixer("sset", control, "--", str(raw))
+
+    def close(self):
+        pass
+
+
+class AlsaError(MixerError): pass
+
+# ctypes is only needed for libasound, so is not imported until an
+# AlsaMixer is created, keeping it out of our start-up time.
+ctypes = None
+PollFD = None
+
+def load_ctypes():
+    """Import ctypes, and define the structures that we use with it."""
+    global ctypes, PollFD
+    if ctypes is not None:
+        return
+    import ctypes
+    import ctypes.util
+
+    class PollFD(ctypes.Structure):
+        _fields_ = [('fd', ctypes.c_int),
+                    ('events', ctypes.c_short),
+                    ('revents', ctypes.c_short)]
+
+class AlsaElement:
+    """The cached handle and ranges for a single mixer element."""
+
+    def __init__(self, ptr, raw_range, db_range, has_switch):
+        self.ptr = ptr
+        self.raw_range = raw_range
+        self.db_range = db_range
+        self.has_switch = has_switch
+
+
+class AlsaMixer:
+    """Control alsa mixer elements in-process through libasound.  The
+    mixer is opened once and each element's handle, raw range and dB
+    range are cached, so reads and writes need neither a fork nor any
+    text parsing."""
+
+    SCHN_FRONT_LEFT = 0
+    DB_GAIN_MUTE = -9999999
+
+    def __init__(self, cardnum):
+        load_ctypes()
+        libname = ctypes.util.find_library('asound')
+        if not libname:
+            raise AlsaError("libasound not found")
+        self.lib = ctypes.CDLL(libname)
+        self.declare_functions()
+        self.cardnum = cardnum
+        self.elements = {}
+        self.handle = ctypes.c_void_p()
+        self.check(self.lib.snd_mixer_open(ctypes.byref(self.handle), 0),
+                   "snd_mixer_open")
+        try:
+            self.check(self.lib.snd_mixer_attach(self.handle,
+                                                 "hw:%d" % cardnum),
+                       "snd_mixer_attach")
+            self.check(self.lib.snd_mixer_selem_register(self.handle,
+                                                         None, None),
+                       "snd_mixer_selem_register")
+            self.check(self.lib.snd_mixer_load(self.handle),
+                       "snd_mixer_load")
+        except AlsaError:
+            self.lib.snd_mixer_close(self.handle)
+            raise
+
+    def declare_functions(self):
+        c_long_p = ctypes.POINTER(ctypes.c_long)
+        c_int_p = ctypes.POINTER(ctypes.c_int)
+        c_void_p = ctypes.c_void_p
+        c_long = ctypes.c_long
+        c_int = ctypes.c_int
+        for name, restype, argtypes in (
+                ('snd_strerror', ctypes.c_char_p, [c_int]),
+                ('snd_mixer_open', c_int,
+                 [ctypes.POINTER(c_void_p), c_int]),
+                ('snd_mixer_close', c_int, [c_void_p]),
+                ('snd_mixer_attach', c_int, [c_void_p, ctypes.c_char_p]),
+                ('snd_mixer_selem_register', c_int,
+                 [c_void_p, c_void_p, c_void_p]),
+                ('snd_mixer_load', c_int, [c_void_p]),
+                ('snd_mixer_handle_events', c_int, [c_void_p]),
+                ('snd_mixer_poll_descriptors_count', c_int, [c_void_p]),
+                ('snd_mixer_poll_descriptors', c_int,
+                 [c_void_p, ctypes.POINTER(PollFD), ctypes.c_uint]),
+                ('snd_mixer_selem_id_malloc', c_int,
+                 [ctypes.POINTER(c_void_p)]),
+                ('snd_mixer_selem_id_free', None, [c_void_p]),
+                ('snd_mixer_selem_id_set_index', None,
+                 [c_void_p, ctypes.c_uint]),
+                ('snd_mixer_selem_id_set_name', None,
+                 [c_void_p, ctypes.c_char_p]),
+                ('snd_mixer_find_selem', c_void_p, [c_void_p, c_void_p]),
+                ('snd_mixer_selem_get_playback_volume_range', c_int,
+                 [c_void_p, c_long_p, c_long_p]),
+                ('snd_mixer_selem_get_playback_dB_range', c_int,
+                 [c_void_p, c_long_p, c_long_p]),
+                ('snd_mixer_selem_has_playback_switch', c_int, [c_void_p]),
+                ('snd_mixer_selem_get_playback_volume', c_int,
+                 [c_void_p, c_int, c_long_p]),
+                ('snd_mixer_selem_set_playback_volume_all', c_int,
+                 [c_void_p, c_long]),
+                ('snd_mixer_selem_get_playback_switch', c_int,
+                 [c_void_p, c_int, c_int_p]),
+                ('snd_mixer_selem_set_playback_switch_all', c_int,
+                 [c_void_p, c_int]),
+                ('snd_mixer_selem_ask_playback_vol_dB', c_int,
+                 [c_void_p, c_long, c_long_p]),
+                ('snd_mixer_selem_ask_playback_dB_vol', c_int,
+                 [c_void_p, c_long, c_int, c_long_p])):
+            function = getattr(self.lib, name)
+            function.restype = restype
+            function.argtypes = argtypes
+
+    def check(self, result, what):
+        if result < 0:
+            raise AlsaError("%s failed on card %d: %s" %
+                            (what, self.cardnum,
+                             self.lib.snd_strerror(result)))
+        return result
+
+    def element(self, control):
+        elem = self.elements.get(control)
+        if elem:
+            return elem
+
+        sid = ctypes.c_void_p()
+        self.check(self.lib.snd_mixer_selem_id_malloc(ctypes.byref(sid)),
+                   "snd_mixer_selem_id_malloc")
+        self.lib.snd_mixer_selem_id_set_index(sid, 0)
+        self.lib.snd_mixer_selem_id_set_name(sid, control)
+        ptr = self.lib.snd_mixer_find_selem(self.handle, sid)
+        self.lib.snd_mixer_selem_id_free(sid)
+        if not ptr:
+            raise AlsaError("No mixer control \"%s\" on card %d" %
+                            (control, self.cardnum))
+
+        low, high = ctypes.c_long(), ctypes.c_long()
+        self.check(self.lib.snd_mixer_selem_get_playback_volume_range(
+            ptr, ctypes.byref(low), ctypes.byref(high)),
+                   "snd_mixer_selem_get_playback_volume_range")
+        raw_range = (low.value, high.value)
+        if (self.lib.snd_mixer_selem_get_playback_dB_range(
+                ptr, ctypes.byref(low), ctypes.byref(high)) < 0 or
+                low.value >= high.value):
+            db_range = None
+        else:
+            db_range = (low.value, high.value)
+        has_switch = self.lib.snd_mixer_selem_has_playback_switch(ptr) != 0
+        elem = AlsaElement(ptr, raw_range, db_range, has_switch)
+        self.elements[control] = elem
+        return elem
+
+    def get_range(self, control):
+        return self.element(control).raw_range
+
+    def raw_to_db(self, control, raw):
+        db = ctypes.c_long()
+        self.check(self.lib.snd_mixer_selem_ask_playback_vol_dB(
+            self.element(control).ptr, raw, ctypes.byref(db)),
+                   "snd_mixer_selem_ask_playback_vol_dB")
+        return db.value
+
+    def db_to_raw(self, control, db):
+        raw = ctypes.c_long()
+        self.check(self.lib.snd_mixer_selem_ask_playback_dB_vol(
+            self.element(control).ptr, db, 1, ctypes.byref(raw)),
+                   "snd_mixer_selem_ask_playback_dB_vol")
+        return raw.value
+
+    def db_range(self, control):
+        """Return the usable dB range of the element, in 1/100 dB units,
+        or None if it has no dB information.  If the element's minimum
+        is a mute, we use the lowest level above that."""
+        elem = self.element(control)
+        if not elem.db_range:
+            return None
+        db_min, db_max = elem.db_range
+        if db_min == AlsaMixer.DB_GAIN_MUTE:
+            db_min = self.raw_to_db(control, elem.raw_range[0] + 1)
+        return db_min, db_max
+
+    def event_fds(self):
+        """Return the file descriptors that become readable when the
+        mixer state is changed by anyone, including ourselves.  The
+        events are consumed by the next get_volume()."""
+        count = self.check(
+            self.lib.snd_mixer_poll_descriptors_count(self.handle),
+            "snd_mixer_poll_descriptors_count")
+        pfds = (PollFD * count)()
+        count = self.check(
+            self.lib.snd_mixer_poll_descriptors(self.handle, pfds, count),
+            "snd_mixer_poll_descriptors")
+        return [pfd.fd for pfd in pfds[:count]]
+
+    def get_volume(self, control):
+        # Bring our cached copy of the mixer state up to date with any
+        # changes made elsewhere.
+        self.lib.snd_mixer_handle_events(self.handle)
+        elem = self.element(control)
+        raw = ctypes.c_long()
+        self.check(self.lib.snd_mixer_selem_get_playback_volume(
+            elem.ptr, AlsaMixer.SCHN_FRONT_LEFT, ctypes.byref(raw)),
+                   "snd_mixer_selem_get_playback_volume")
+        mute = False
+        if elem.has_switch:
+            switch = ctypes.c_int()
+            self.check(self.lib.snd_mixer_selem_get_playback_switch(
+                elem.ptr, AlsaMixer.SCHN_FRONT_LEFT, ctypes.byref(switch)),
+                       "snd_mixer_selem_get_playback_switch")
+            mute = switch.value == 0
+        return raw.value, mute
+
+    def set_mute(self, control, mute):
+        elem = self.element(control)
+        if elem.has_switch:
+            self.check(self.lib.snd_mixer_selem_set_playback_switch_all(
+                elem.ptr, 0 if mute else 1),
+                       "snd_mixer_selem_set_playback_switch_all")
+
+    def set_volume(self, control, raw):
+        self.check(self.lib.snd_mixer_selem_set_playback_volume_all(
+            self.element(control).ptr, raw),
+                   "snd_mixer_selem_set_playback_volume_all")
+
+    def close(self):
+        self.lib.snd_mixer_close(self.handle)
+        self.elements = {}
+
+
+class SimMixer:
+    """A simulated mixer, for benchmarking and testing volumed with
+    realistic timing on machines without the real hardware.  It models
+    a raw range with a dB scale linear across it, and is configured by
+    a spec of comma separated name=value settings:
+
+      range=MIN:MAX   raw volume range (default 0:207)
+      db=MIN:MAX      dB range in 1/100 dB (default -10350:0)
+      latency=MS      mean latency of each call (default 0)
+      jitter=MS       spread of that latency (default 0)
+      dist=NAME       latency distribution: normal, uniform or exp
+      timeouts=P      probability of a call hanging then failing
+      hang=S          how long a hanging call takes (default 5)
+      errors=P        probability of a call failing as if its output
+                      could not be parsed
+      changes=S       mean interval between out of band volume and mute
+                      changes (default 0, for none)
+      events=on|off   whether changes are signalled through event_fds()
+
+    Faults may also be injected on demand, through inject()."""
+
+    DEFAULTS = {'range': '0:207', 'db': '-10350:0', 'latency': '0',
+                'jitter': '0', 'dist': 'normal', 'timeouts': '0',
+                'hang': '5', 'errors': '0', 'changes': '0',
+                'events': 'on'}
+
+    def __init__(self, cardnum, spec):
+        self.random = random.Random()
+        self.cardnum = cardnum
+        settings = dict(SimMixer.DEFAULTS)
+        for setting in [s for s in spec.split(',') if s.strip()]:
+            name, _, value = setting.partition('=')
+            if name.strip() not in settings:
+                raise ValueError("Unknown simulation setting: %s" % name)
+            settings[name.strip()] = value.strip()
+        self.raw_range = tuple(int(v) for v in settings['range'].split(':'))
+        self.db = tuple(int(v) for v in settings['db'].split(':'))
+        self.latency = float(settings['latency']) / 1000.0
+        self.jitter = float(settings['jitter']) / 1000.0
+        self.dist = settings['dist']
+        self.timeouts = float(settings['timeouts'])
+        self.hang = float(settings['hang'])
+        self.errors = float(settings['errors'])
+        self.changes = float(settings['changes'])
+        self.events = settings['events'] == 'on'
+        self.controls = {}
+        self.injected = []
+        self.calls = 0
+        self.faults = 0
+        self.event_r, self.event_w = os.pipe()
+        for fd in (self.event_r, self.event_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.changer = None
+        if self.changes > 0:
+            self.changer = gevent.spawn(self.change_randomly)
+
+    def delay(self):
+        if self.dist == 'uniform':
+            delay = self.random.uniform(self.latency - self.jitter,
+                                        self.latency + self.jitter)
+        elif self.dist == 'exp':
+            delay = self.latency + (self.random.expovariate(
+                1.0 / self.jitter) if self.jitter else 0)
+        else:
+            delay = self.random.gauss(self.latency, self.jitter)
+        return max(0, delay)
+
+    def call(self, what):
+        """Simulate the cost, and any failure, of a call."""
+        self.calls += 1
+        fault = self.injected.pop(0) if self.injected else None
+        if fault is None:
+            if self.random.random() < self.timeouts:
+                fault = 'timeout'
+            elif self.random.random() < self.errors:
+                fault = 'error'
+        if fault == 'timeout':
+            self.faults += 1
+            time.sleep(self.hang)
+            raise MixerError("Simulated timeout in %s" % what)
+        time.sleep(self.delay())
+        if fault == 'error':
+            self.faults += 1
+            raise MixerError("Simulated unparseable output from %s" % what)
+
+    def inject(self, fault):
+        """Make the next call fail with a timeout or error, or make an
+        out of band change now."""
+        if fault == 'change':
+            self.change_randomly(once=True)
+        else:
+            self.injected.append(fault)
+
+    def control(self, control):
+        if control not in self.controls:
+            self.controls[control] = [self.raw_range[1], False]
+        return self.controls[control]
+
+    def changed(self):
+        if self.events:
+            try:
+                os.write(self.event_w, 'x')
+            except OSError as e:
+                # A full pipe already has events waiting.
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def change_randomly(self, once=False):
+        while True:
+            if not once:
+                time.sleep(self.random.expovariate(1.0 / self.changes))
+            for state in self.controls.values():
+                if self.random.random() < 0.2:
+                    state[1] = not state[1]
+                else:
+                    state[0] = self.random.randint(*self.raw_range)
+            self.changed()
+            if once:
+                return
+
+    def event_fds(self):
+        if not self.events:
+            return None
+        return [self.event_r]
+
+    def close(self):
+        """Stop making out of band changes, and close the event pipe."""
+        if self.changer:
+            self.changer.kill()
+            self.changer = None
+        os.close(self.event_r)
+        os.close(self.event_w)
+
+    def get_range(self, control):
+        return self.raw_range
+
+    def raw_to_db(self, control, raw):
+        raw_min, raw_max = self.raw_range
+        return int(self.db[0] + (self.db[1] - self.db[0]) *
+                   (raw - raw_min) / float(raw_max - raw_min))
+
+    def db_to_raw(self, control, db):
+        raw_min, raw_max = self.raw_range
+        raw = raw_min + ((db - self.db[0]) * (raw_max - raw_min) /
+                         float(self.db[1] - self.db[0]))
+        return min(max(int(math.ceil(raw)), raw_min), raw_max)
+
+    def db_range(self, control):
+        return self.db
+
+    def get_volume(self, control):
+        self.call("get_volume")
+        if self.events:
+            # Consume any pending events, as alsa's handle_events does.
+            try:
+                os.read(self.event_r, 4096)
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+        state = self.control(control)
+        return state[0], state[1]
+
+    def set_mute(self, control, mute):
+        self.call("set_mute")
+        self.control(control)[1] = mute
+        self.changed()
+
+    def set_volume(self, control, raw):
+        self.call("set_volume")
+        raw_min, raw_max = self.raw_range
+        self.control(control)[0] = min(max(raw, raw_min), raw_max)
+        self.changed()
+
+
 class HWInterface:
-    """Provide an interface to the volume control hardware."""
+    """Provide an interface to the volume control hardware.  Volumes
+    are read and written as raw mixer values (for mpd, its 0-100 volume
+    setting).  The curve() method provides the mapping between these
+    and volume percentages."""
 
-    def __init__(self, db):
+    SOFTWARE_CURVE = VolumeCurve.linear(0, 100)
+
+    def __init__(self, db, options, cardnum=None):
         self.db = db
-        self.volume_re = re.compile(
-          "([0-9]*)?[^0-9]*([0-9]+)%(.*\[(on|off)\])?")
-        self.cardnum = self.get_cardnum()
+        if cardnum is None:
+            cardnum = self.get_cardnum()
+        self.cardnum = cardnum
+        self.mpd = MPDClient(options.mpd_host, options.mpd_port)
+        self.mpd_events = MPDClient(options.mpd_host, options.mpd_port)
+        self.options = options
+        self.db_curve = options.curve == 'db'
+        self.curves = {}
+
+    def __getattr__(self, name):
+        # The mixer is only opened when first used, so that we can start
+        # serving before probing the hardware.
+        if name == 'mixer':
+            self.mixer = self.open_mixer(self.options)
+            return self.mixer
+        raise AttributeError(name)
+
+    def simulated(self):
+        """Whether our mixer is (or will be) a SimMixer.  This does not
+        open the mixer."""
+        return self.options.simulate is not None
+
+    def use_mixer(self):
+        """Whether we control the volume through the mixer rather than
+        mpd.  A simulated mixer is always used."""
+        return self.db.mpd_mixer == 'hardware' or self.simulated()
         
+    def signature(self):
+        """Identify the hardware, so that we can tell whether a state
+        snapshot was taken with the same card and control."""
+        try:
+            with open("/proc/asound/card%d/id" % self.cardnum) as f:
+                card_id = f.read().strip()
+        except IOError:
+            card_id = None
+        return {'card': self.cardnum, 'card_id': card_id,
+                'control': self.db.alsa_mixer, 'mixer': self.db.mpd_mixer,
+                'simulate': self.options.simulate}
+
+    def saved_curves(self):
+        """Return our curve tables, for a state snapshot."""
+        return [{'key': list(key), 'raw_min': curve.raw_min,
+                 'raw_max': curve.raw_max, 'table': curve.forward}
+                for key, curve in self.curves.items()]
+
+    def restore_curves(self, saved):
+        """Restore curve tables from a state snapshot, so that we need
+        neither probe the mixer nor rebuild them."""
+        for entry in saved:
+            self.curves[tuple(entry['key'])] = VolumeCurve(
+                entry['raw_min'], entry['raw_max'], entry['table'])
+
+    def verify_curves(self):
+        """Drop any curve whose range does not match the mixer's (eg one
+        restored from a snapshot taken before the mixer changed)."""
+        if not self.use_mixer():
+            return
+        for key, curve in self.curves.items():
+            if (curve.raw_min, curve.raw_max) != self.mixer.get_range(key[0]):
+                del self.curves[key]
+
     def get_cardnum(self):
         """Based on vol.sh, though I am not entirely convinced.  My use
         case for the music box includes having a usb audio capture
@@ -117,80 +1185,175 @@ class HWInterface:
             return 1
         except IOError:
             return 0
+
+    def open_mixer(self, options):
+        """Use libasound directly if we can, falling back to amixer if
+        we cannot."""
+        if options.simulate is not None:
+            return SimMixer(self.cardnum, options.simulate)
+        if not options.amixer:
+            try:
+                return AlsaMixer(self.cardnum)
+            except (OSError, AttributeError, AlsaError) as e:
+                sys.stderr.write("Unable to use libasound (%s).  "
+                                 "Falling back to amixer.\n" % e)
+        return AmixerMixer(self.cardnum)
         
-    def get_volume(self):
-        if self.db.mpd_mixer == 'hardware':
-            if self.db.volcurve == 'Yes':
-                cmd = ("amixer -c %d sget %s -M" %
-                       (self.cardnum, self.db.alsa_mixer))
-            else:
-                cmd = ("amixer -c %d sget %s" %
-                       (self.cardnum, self.db.alsa_mixer))
-        else:
-            cmd = "mpc"
-
-        # TODO: Put in some error handling here    
-        out = subprocess.check_output(cmd.split(' '))
-        match = self.volume_re.search(out)
-        vol = int(match.group(2))
-        if self.db.mpd_mixer == 'hardware':
-            mute = match.group(4) == 'off'
+    def event_fds(self):
+        """Return a list of file descriptors that will become readable
+        when the volume or mute status may have changed, or None if we
+        have no such source of events and must poll.  Once any become
+        readable, consume_events() should be called with them."""
+        if self.use_mixer():
+            return self.mixer.event_fds()
+        return [self.mpd_events.start_idle('mixer')]
+
+    def consume_events(self, fds):
+        if not self.use_mixer():
+            if self.mpd_events.idling:
+                self.mpd_events.idle_changes()
+
+    def curve(self):
+        """Return the VolumeCurve for the current mixer and curve
+        settings, building it only if those have changed."""
+        if not self.use_mixer():
+            return HWInterface.SOFTWARE_CURVE
+
+        control = self.db.alsa_mixer
+        if self.db.volcurve == 'Yes':
+            key = (control, 'log', int(self.db.volcurvefac))
+        elif self.db_curve:
+            key = (control, 'db')
         else:
-            mute = (vol == 0) and (self.db.mute == 'True')
-            vol = self.db.level
+            key = (control, 'linear')
+        curve = self.curves.get(key)
+        if not curve:
+            raw_min, raw_max = self.mixer.get_range(control)
+            db_range = self.mixer.db_range(control)
+            if key[1] == 'log':
+                curve = VolumeCurve.logarithmic(raw_min, raw_max, key[2])
+            elif key[1] == 'db' and db_range:
+                curve = VolumeCurve.db_linear(
+                    raw_min, raw_max, db_range[0], db_range[1],
+                    lambda db: self.mixer.db_to_raw(control, db))
+            else:
+                if key[1] == 'db':
+                    # Eg amixer is being used, or the control has no dB
+                    # scale.
+                    sys.stderr.write("No dB scale for %s: using a linear "
+                                     "volume curve instead.\n" % control)
+                curve = VolumeCurve.linear(raw_min, raw_max)
+            self.curves[key] = curve
+        return curve
+
+    @timed('get_volume')
+    def get_volume(self):
+        if self.use_mixer():
+            return self.mixer.get_volume(self.db.alsa_mixer)
+
+        vol = self.mpd_call(self.mpd.get_volume)
+        mute = (vol == 0) and (self.db.mute == 'True')
+        if mute:
+            # Muting sets the volume to zero, so report the volume that
+            # we will restore on unmute.
+            vol = self.curve().to_raw(self.db.level)
         return vol, mute
     
+    @timed('set_mute')
     def set_mute(self, mute=True):
-        if self.db.mpd_mixer == 'hardware':
-            cmd = ("amixer -c %d sset %s %s" %
-                   (self.cardnum, self.db.alsa_mixer,
-                    'mute' if mute else 'unmute'))
-            out = subprocess.check_output(cmd.split(' '))
+        if self.use_mixer():
+            self.mixer.set_mute(self.db.alsa_mixer, mute)
         else:
-            # We think we do not have a h/w mute as we must use mpc
+            # We think we do not have a h/w mute as we must use mpd
             if mute:
                 self.set_volume(0)
             else:
-                self.set_volume(self.db.level)
+                self.set_volume(self.curve().to_raw(self.db.level))
         
-    def set_volume(self, volume):
-        if self.db.mpd_mixer == 'hardware':
-            if self.db.volcurve == 'Yes':
-              cmd = ("amixer -c %d sset %s -M% d%%" %
-                       (self.cardnum, self.db.alsa_mixer, volume))
-            else:
-                cmd = ("amixer -c %d sset %s %d%%" %
-                       (self.cardnum, self.db.alsa_mixer, volume))
+    @timed('set_volume')
+    def set_volume(self, raw):
+        if self.use_mixer():
+            self.mixer.set_volume(self.db.alsa_mixer, raw)
         else:
-            cmd = "mpc volume %s" % volume
-
-        # TODO: log the following?
-        out = subprocess.check_output(cmd.split(' '))
-        match = self.volume_re.search(out)
-        result = int(match.group(2))
-        if result != volume:
-            # We have a discrepency between what we requested and what
-            # we got back.  This is probably due to rounding errors in
-            # the pct calculation, so let's try to overcome them.
-            if match.group(1):
-                # We have an actual value as well as a pct.  Let's
-                # try incrementing or decrementing it.
-                actual = int(match.group(1))
-                if result < volume:
-                    actual += 1
-                else:
-                    actual -= 1
-                if self.db.mpd_mixer == 'hardware':
-                    cmd = ("amixer -c %d sset %s %d" %
-                           (self.cardnum, self.db.alsa_mixer, actual))
-                    out = subprocess.check_output(cmd.split(' '))
+            self.mpd_call(self.mpd.set_volume, raw)
+
+    def close(self):
+        """Close the mixer, if it has been opened, and our connections
+        to mpd."""
+        mixer = self.__dict__.pop('mixer', None)
+        if mixer:
+            mixer.close()
+        self.mpd.disconnect()
+        self.mpd_events.disconnect()
+
+    def mpd_call(self, method, *args):
+        """Call an MPDClient method, reporting a lost or refused
+        connection to mpd as a MixerError, as the mixer would."""
+        try:
+            return method(*args)
+        except (socket.error, EOFError) as e:
+            raise MixerError("Unable to reach mpd: %s" % e)
+
+
+class DBWriter(ThreadPlus):
+    """Flush the DB's dirty fields in the background.  A flush happens
+    once there have been no updates for FLUSH_DELAY seconds, but never
+    more than FLUSH_MAX_DELAY seconds after the first unflushed update,
+    so that a burst of updates (eg from dragging the volume knob)
+    results in a single commit."""
+    FLUSH_DELAY = 1.0
+    FLUSH_MAX_DELAY = 5.0
+
+    def __init__(self, db):
+        super(DBWriter, self).__init__()
+        self.db = db
+        self.pending = gevent.event.Event()
+        self.first_update = None
+        self.start()
+
+    def schedule(self):
+        now = time.time()
+        with self.target_lock:
+            if self.first_update is None:
+                self.first_update = now
+            self.sleep_target = min(now + DBWriter.FLUSH_DELAY,
+                                    self.first_update +
+                                    DBWriter.FLUSH_MAX_DELAY)
+        self.pending.set()
+
+    def stop(self):
+        super(DBWriter, self).stop()
+        self.pending.set()
+
+    def run(self):
+        while self.running:
+            self.pending.wait()
+            self.pending.clear()
+            delay = max(0, self.target() - time.time())
+            if self.running and self.sleep(delay):
+                with self.target_lock:
+                    self.first_update = None
+                self.db.flush()
+        self.db.flush()
 
 
 class DB:
     """Provide a simple setter/getter interface to the database
-    fields."""
+    fields.
+
+    Updates are write-behind: the new value is immediately visible
+    through the DB object, but is only written to the database by
+    flush(), which writes all dirty fields in a single transaction.  If
+    a DBWriter is in use, flush() is called for us; otherwise updates
+    are flushed immediately.  Call close() to flush any outstanding
+    updates at shutdown.
+
+    All fields are read in a single query, and are only re-read when
+    the database has been changed by some other writer (eg the php UI
+    or vol.sh).  We check for such changes at most every CHECK_INTERVAL
+    seconds, so reading a field is usually just a dict lookup."""
     
-    STALE_LIMIT = 2.0
+    CHECK_INTERVAL = 0.25
     FIELD_IDS = {'volcurve': 32,
                  'volcurvefac': 56,
                  'max_pct': 34,
@@ -200,45 +1363,139 @@ class DB:
                  'alsa_mixer': 39,
                  'mpd_mixer': 40}
     
-    def __init__(self, dbname):
+    def __init__(self, dbname, write_behind=True, wal=False):
         self.dbname = dbname
-        self.connection = sqlite3.connect(self.dbname)
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(self.dbname,
+                                          check_same_thread=False)
+        if wal:
+            self.connection.execute("pragma journal_mode = wal")
+        self.cursor = self.connection.cursor()
         self.fields = {}
-        self.fetchtimes = {}
+        self.stored = {}
+        self.dirty = {}
+        self.updates = 0
+        self.fields_written = 0
+        self.commits = 0
+        self.loads = 0
+        self.traces = []
+        self.version = None
+        self.next_check = 0
+        self.cursor.execute("pragma data_version")
+        self.has_data_version = self.cursor.fetchone() is not None
         for field in DB.FIELD_IDS:
             self.fields[field] = None
-            self.fetchtimes[field] = 0
+            self.stored[field] = None
+        self.writer = DBWriter(self) if write_behind else None
+
+    def data_version(self):
+        """Return a value that changes whenever another connection
+        commits a change to the database.  If our sqlite is too old to
+        provide data_version, the file's modification time will do."""
+        if self.has_data_version:
+            self.cursor.execute("pragma data_version")
+            return self.cursor.fetchone()[0]
+        return os.stat(self.dbname).st_mtime
+
+    def load(self):
+        """Read all of our fields in a single query.  Fields with
+        unflushed updates keep their updated values, unless some other
+        writer has since changed that field in the database, in which
+        case the other writer's change wins."""
+        ids = {}
+        for field, id in DB.FIELD_IDS.items():
+            ids[id] = field
+        qry = ("select id, value from cfg_engine where id in (%s)" %
+               ", ".join([str(id) for id in ids]))
+        start = time.time()
+        self.cursor.execute(qry)
+        for id, value in self.cursor.fetchall():
+            field = ids[id]
+            if field in self.dirty:
+                # Values are stored as text, so compare them as such.
+                if value == self.stored[field]:
+                    continue
+                del self.dirty[field]
+            self.fields[field] = value
+            self.stored[field] = value
+        self.loads += 1
+        METRICS.observe('volumed_db_load_seconds', time.time() - start)
+
+    def refresh(self, force=False):
+        now = time.time()
+        if force or now >= self.next_check:
+            self.next_check = now + DB.CHECK_INTERVAL
+            version = self.data_version()
+            if version != self.version:
+                self.version = version
+                self.load()
         
     def fetch(self, field):
-        now = time.time()    
-        if self.fetchtimes[field] + DB.STALE_LIMIT < now:
-            # We do not have an up-to-date value for the field, so we
-            # will fetch it.  This time-based approach allows us to use
-            # our database fields as simple attributes of the DB object
-            # without having to be concerned about the cost of fetches:
-            # we will fetch from the database when the local copy is
-            # stale and use our cached version otherwise.
-            qry = ("select value from cfg_engine where id = %d" %
-                   DB.FIELD_IDS[field])
-            c = self.connection.cursor()
-            c.execute(qry)
-            res = c.fetchall()
-            self.fetchtimes[field] = now
-            self.fields[field] = res[0][0]
-        return self.fields[field]
+        with self.lock:
+            self.refresh()
+            return self.fields[field]
 
     def update(self, field, value):
-        if value != self.fetch(field):
-            # Only update the database if the value is known to have
-            # changed.
-            qry = ("update cfg_engine set value = '%s' where id = %d" %
-                   (value, DB.FIELD_IDS[field]))
-            c = self.connection.cursor()
-            c.execute(qry)
+        with self.lock:
+            if value == self.fetch(field):
+                # Only update the database if the value is known to
+                # have changed.
+                return
             self.fields[field] = value
+            self.dirty[field] = value
+            self.updates += 1
+        if self.writer:
+            self.writer.schedule()
+        else:
+            self.flush()
+
+    def flush(self):
+        """Write all dirty fields to the database in one transaction."""
+        with self.lock:
+            # Make sure that we don't overwrite anything more recently
+            # written by someone else.
+            self.refresh(True)
+            if not self.dirty:
+                return
+            start = time.time()
+            c = self.connection.cursor()
+            for field, value in self.dirty.items():
+                qry = ("update cfg_engine set value = '%s' where id = %d" %
+                       (value, DB.FIELD_IDS[field]))
+                c.execute(qry)
+                self.stored[field] = str(value)
             self.connection.commit()
-            #res = c.fetchall()
-            self.fetchtimes[field] = time.time()
+            METRICS.observe('volumed_db_commit_seconds', time.time() - start)
+            self.fields_written += len(self.dirty)
+            self.commits += 1
+            self.dirty = {}
+            for trace in self.traces:
+                trace.mark('db_commit')
+            self.traces = []
+
+    def trace_commit(self, traces):
+        """Mark each trace when the current updates are committed."""
+        with self.lock:
+            if self.dirty:
+                self.traces.extend(traces)
+                return
+        for trace in traces:
+            trace.mark('db_commit')
+
+    def close(self):
+        if self.writer:
+            self.writer.stop()
+            self.writer.join()
+        self.flush()
+
+    def stats(self):
+        """Return a summary of how effectively updates have been
+        coalesced."""
+        return ("DB updates: %d, fields written: %d, commits: %d, "
+                "coalesced: %d, loads: %d" %
+                (self.updates, self.fields_written, self.commits,
+                 self.updates - self.fields_written - len(self.dirty),
+                 self.loads))
         
     def __getattr__(self, name):
         return self.fetch(name)
@@ -247,53 +1504,572 @@ class DB:
         if name in DB.FIELD_IDS:
             self.update(name, value)
         else:
-            self.__dict__[name] = value
+            self.__dict__[name] = value
+
+
+
+class ZoneSettings:
+    """The settings and state of a zone other than the default one.
+    These are not part of moode's database, so are simply held in
+    memory, providing the same interface as DB."""
+
+    def __init__(self, alsa_mixer, max_pct=100):
+        self.fields = {'volcurve': 'No',
+                       'volcurvefac': '0',
+                       'max_pct': str(max_pct),
+                       'level': '0',
+                       'mute': 'False',
+                       'warning_level': str(max_pct),
+                       'alsa_mixer': alsa_mixer,
+                       'mpd_mixer': 'hardware'}
+
+    def close(self):
+        pass
+
+    def stats(self):
+        return None
+
+    def trace_commit(self, traces):
+        pass
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['fields'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name in self.__dict__.get('fields', {}):
+            self.fields[name] = value
+        else:
+            self.__dict__[name] = value
+
+
+
+class StateSnapshot:
+    """A small file holding each zone's volume and mute state, along with
+    what we have learnt of its hardware: the card, control and the curve
+    tables built from the mixer's range.  When restarting on the same
+    hardware, this lets us answer requests at once, and skip probing the
+    mixer, while the hardware is checked in the background.
+
+    Zones register a function returning their current state, and call
+    changed() when it changes.  As with the DB, writes are coalesced by
+    a DBWriter.  Each write replaces the file atomically, so a crash
+    leaves either the old snapshot or the new one."""
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.zones = self.read()
+        self.sources = {}
+        self.written = None
+        self.lock = threading.RLock()
+        self.writer = DBWriter(self)
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                snapshot = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if not isinstance(snapshot, dict) or (
+                snapshot.get('version') != StateSnapshot.VERSION):
+            return {}
+        return snapshot.get('zones', {})
+
+    def saved(self, name):
+        """Return the state saved for the named zone, if any."""
+        return self.zones.get(name)
+
+    def register(self, name, source):
+        self.sources[name] = source
+
+    def changed(self):
+        self.writer.schedule()
+
+    def flush(self):
+        with self.lock:
+            zones = dict([(name, source())
+                          for name, source in self.sources.items()])
+            if zones == self.written:
+                return
+            temp = "%s.tmp" % self.path
+            try:
+                with open(temp, 'w') as f:
+                    json.dump({'version': StateSnapshot.VERSION,
+                               'zones': zones}, f, sort_keys=True)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.rename(temp, self.path)
+            except (IOError, OSError) as e:
+                sys.stderr.write("Unable to write %s: %s\n" % (self.path, e))
+                return
+            self.written = zones
+
+    def close(self):
+        self.writer.stop()
+        self.writer.join()
+        self.flush()
+
+
+class VolumeMonitor(ThreadPlus):
+    """Report out of band changes to volume or mute.  Where the
+    hardware interface can notify us of changes (alsa mixer events or
+    mpd's idle command), we wait for those and report any change
+    immediately, polling only occasionally as a fallback.  Otherwise we
+    simply poll."""
+    RESOLUTION = 2.0
+    EVENT_RESOLUTION = 30.0
+
+    def __init__(self, controller, events=True, deferred=False):
+        """If deferred, the hardware is not read until the monitor is
+        running, so that we can start answering requests from the
+        controller's record of the state at once."""
+        super(VolumeMonitor, self).__init__()
+        self.controller = controller
+        self.hw_interface = controller.hw_interface
+        self.events = events
+        self.deferred = deferred
+        self.events_suspended_until = 0
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        try:
+            self.volume, self.mute = self.controller.get_volume(not deferred)
+        except MixerError as e:
+            sys.stderr.write("Unable to read volume: %s\n" % e)
+            self.volume, self.mute = None, None
+        self.start()
+
+    def stop(self):
+        super(VolumeMonitor, self).stop()
+        os.write(self.wakeup_w, 'x')
+
+    def report_change(self, refresh=False):
+        """Tell watchers about any change in state.  If refresh is set,
+        read the state from the hardware rather than relying on the
+        controller's record of what it has written."""
+        volume, mute = self.controller.get_volume(refresh)
+        if (volume != self.volume) or (mute != self.mute):
+            if refresh:
+                # Our own changes are recorded before we get here, so
+                # this was made by someone else.
+                METRICS.count('volumed_external_changes_total')
+            self.volume, self.mute = volume, mute
+            self.controller.update_watchers(volume, mute)
+
+    def trigger_recheck(self):
+        os.write(self.wakeup_w, 'x')
+
+    def suspend_events(self, error):
+        # Fall back to polling for a while rather than risk spinning on
+        # an event source that keeps failing.
+        sys.stderr.write("Volume events unavailable: %s\n" % error)
+        self.events_suspended_until = (time.time() +
+                                       VolumeMonitor.EVENT_RESOLUTION)
+
+    def event_fds(self):
+        if self.events and time.time() >= self.events_suspended_until:
+            try:
+                return self.hw_interface.event_fds()
+            except (socket.error, MixerError) as e:
+                self.suspend_events(e)
+        return None
+
+    def wait_for_change(self):
+        """Wait until a change may have occurred, or until it is time to
+        poll.  Return True if we are still running."""
+        fds = self.event_fds()
+        if fds is None:
+            fds, timeout = [], VolumeMonitor.RESOLUTION
+        else:
+            timeout = VolumeMonitor.EVENT_RESOLUTION
+        ready = select.select(fds + [self.wakeup_r], [], [], timeout)[0]
+        if self.wakeup_r in ready:
+            os.read(self.wakeup_r, 64)
+            ready.remove(self.wakeup_r)
+        if ready:
+            if DEBUG:
+                print "VOLUME EVENT ON: %s" % ready
+            try:
+                self.hw_interface.consume_events(ready)
+            except (socket.error, MixerError) as e:
+                self.suspend_events(e)
+        return self.running
+            
+    def check(self):
+        try:
+            self.report_change(True)
+        except MixerError as e:
+            METRICS.count('volumed_mixer_errors_total')
+            sys.stderr.write("Unable to read volume: %s\n" % e)
+
+    def run(self):
+        if self.deferred:
+            # Check the state that we started with against the hardware,
+            # telling the watchers if it was wrong.
+            try:
+                self.hw_interface.verify_curves()
+            except MixerError as e:
+                sys.stderr.write("Unable to read mixer range: %s\n" % e)
+            self.check()
+        while self.wait_for_change():
+            self.check()
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+            
+
+class SocketWriter:
+    """Send messages to a single client socket from a greenlet of its
+    own, so that a client on a slow connection cannot hold up the
+    controller or any other client.
+
+    Status messages replace any status message for the same zone that
+    has not yet been sent, as only the latest status matters.  The
+    status argument to put() is False for other messages, and otherwise
+    identifies the zone.  A client that falls too far behind is evicted:
+    its connection is dropped.  We judge this by whether a send to it
+    has been blocked for too long, not by the number of unsent messages,
+    as many may be queued at once for a client that is reading them
+    perfectly well."""
+    SEND_TIMEOUT = 10.0
+
+    def __init__(self, sock, evicted):
+        self.socket = sock
+        self.evicted = evicted
+        self.pending = []
+        self.ready = gevent.event.Event()
+        self.sending_since = None
+        self.closed = False
+        self.greenlet = gevent.spawn(self.run)
+
+    def lagging(self):
+        return (self.sending_since is not None and
+                time.time() - self.sending_since > SocketWriter.SEND_TIMEOUT)
+
+    def put(self, msg, status=True, traces=()):
+        """Queue msg for sending, marking each of traces once it has been
+        sent."""
+        if self.closed:
+            return
+        if status:
+            traces = list(traces)
+            for entry in self.pending:
+                if entry[0] == status:
+                    # The replacement carries the traces waiting on the
+                    # message it replaces.
+                    traces.extend(entry[2])
+            self.pending = [entry for entry in self.pending
+                            if entry[0] != status]
+        if self.lagging():
+            METRICS.count('volumed_evictions_total')
+            sys.stderr.write("Evicting slow client.  Msg: \"%s\".\n" %
+                             msg.strip())
+            self.evict()
+        else:
+            self.pending.append((status, msg, traces))
+            self.ready.set()
+
+    def close(self):
+        """Close the socket once all pending messages have been sent."""
+        if not self.closed:
+            self.pending.append((False, None, ()))
+            self.ready.set()
+
+    def stop(self):
+        self.closed = True
+        self.ready.set()
+
+    def evict(self):
+        self.stop()
+        if gevent.getcurrent() is not self.greenlet:
+            # We may be stuck in a send.
+            self.greenlet.kill(block=False)
+        try:
+            self.socket.close_connection()
+        except Exception:
+            pass
+        self.evicted(self.socket)
+
+    def run(self):
+        while not self.closed:
+            self.ready.wait()
+            self.ready.clear()
+            while self.pending and not self.closed:
+                status, msg, traces = self.pending.pop(0)
+                if msg is None:
+                    self.closed = True
+                    try:
+                        self.socket.close()
+                    except Exception:
+                        pass
+                    break
+                if DEBUG:
+                    sys.stdout.write("SENDING MESSAGE: \"%s\"..." %
+                                     msg.strip())
+                self.sending_since = time.time()
+                try:
+                    self.socket.send(msg)
+                    STARTUP.responded()
+                    if DEBUG:
+                        print "SENT"
+                    for trace, kind in traces:
+                        trace.mark('sent', kind)
+                except Exception:
+                    # Assume the socket was closed, not much we can do.
+                    if DEBUG:
+                        print ""
+                    for trace, kind in traces:
+                        trace.mark('send_failed', kind)
+                    METRICS.count('volumed_send_failures_total')
+                    sys.stderr.write("Send failed.  Msg: \"%s\".\n" %
+                                     msg.strip())
+                    self.evict()
+                self.sending_since = None
+
+
+class VolumeRamp:
+    """Schedule volume writes to the hardware.  The volume is treated as
+    a target: writes are made at most max_rate times per second, each
+    going straight to the most recent target, so a fast drag results in
+    a bounded number of writes and always ends at the last position.
+    Alternatively the ramp may be fading, in which case each write moves
+    one step along a linear path to the fade's end level.
+
+    The ramp also keeps the sleep timer, which starts a fade-out when it
+    expires."""
+
+    def __init__(self, max_rate):
+        self.interval = 1.0 / max_rate
+        self.last_write = 0
+        self.level = None       # The level most recently written
+        self.target = None
+        self.fade = None        # (start_level, end_level, start, duration)
+        self.sleep_at = None
+
+    def set_target(self, level):
+        self.target = level
+        self.fade = None
+
+    def start_fade(self, start_level, end_level, duration, now):
+        self.target = None
+        if duration <= 0 or start_level == end_level:
+            self.fade = None
+            self.target = end_level
+        else:
+            self.level = start_level
+            self.fade = (start_level, end_level, now, float(duration))
 
-            
-class VolumeMonitor(ThreadPlus):
-    RESOLUTION = 2.0
+    def cancel_fade(self):
+        self.fade = None
 
-    def __init__(self, controller):
-        super(VolumeMonitor, self).__init__()
-        self.controller = controller
-        self.volume, self.mute = self.controller.get_volume()
-        self.start()
+    def fade_level(self, now):
+        start_level, end_level, start, duration = self.fade
+        progress = min((now - start) / duration, 1.0)
+        return start_level + int((end_level - start_level) * progress)
 
-    def report_change(self):
-        volume, mute = self.controller.get_volume()
-        if (volume != self.volume) or (mute != self.mute):
-            self.volume, self.mute = volume, mute
-            self.controller.update_watchers(volume, mute)
+    def next_change(self):
+        """Return the time at which the fade will next change level."""
+        start_level, end_level, start, duration = self.fade
+        step = 1 if end_level > start_level else -1
+        progress = float(self.level + step - start_level) / (end_level -
+                                                            start_level)
+        return start + duration * progress
+
+    def delay(self, now):
+        """Return the number of seconds until the next write, or sleep
+        timer expiry, is due, or None if there is nothing to do."""
+        due = []
+        if self.target is not None:
+            due.append(self.last_write + self.interval)
+        elif self.fade:
+            due.append(max(self.last_write + self.interval,
+                           self.next_change()))
+        if self.sleep_at is not None:
+            due.append(self.sleep_at)
+        if due:
+            return max(min(due) - now, 0)
+        return None
+
+    def next_level(self, now, force=False):
+        """Return the level that should be written now, if any.  If
+        force is set, the rate limit is ignored."""
+        if not force and now < self.last_write + self.interval:
+            return None
+        if self.target is not None:
+            level, self.target = self.target, None
+            return level
+        if self.fade:
+            level = self.fade_level(now)
+            if level == self.fade[1]:
+                self.fade = None
+            if level != self.level:
+                return level
+        return None
+
+    def written(self, level, now):
+        self.level = level
+        self.last_write = now
+
+    def idle(self):
+        return self.target is None and self.fade is None
+
+
+class TokenBucket:
+    """Admission control for a connection: commands are admitted at up
+    to rate per second on average, with bursts of up to burst commands
+    allowed."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.time()
+
+    def take(self):
+        """Return True if a command may be admitted now."""
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class MergedCommands:
+    """The net result of a series of commands from one connection,
+    queued as a single entry once the connection has exceeded its quota
+    or the queue is full.  Absolute and relative volume changes combine
+    into one, the last of mute and unmute wins, and queries are answered
+    once, with the resulting state.  Other commands cannot be merged."""
+    CMDS = ('set', 'delta', 'mute', 'unmute', 'get', 'refresh')
+
+    def __init__(self):
+        self.level = None       # The absolute level asked for, if any
+        self.delta = None       # Or the net relative change
+        self.mute = None
+        self.get = False
+        self.refresh = False
+
+    def add(self, cmd, val):
+        if cmd == 'set':
+            self.level, self.delta = val, None
+        elif cmd == 'delta':
+            if self.level is not None:
+                self.level += val
+            else:
+                self.delta = (self.delta or 0) + val
+        elif cmd in ('mute', 'unmute'):
+            self.mute = cmd
+        elif cmd == 'refresh':
+            self.refresh = True
+        else:
+            self.get = True
+
+    def commands(self):
+        """Return the (cmd, val) pairs that have the same effect as the
+        commands merged.  Every merged command that expects an answer
+        gets one from these."""
+        commands = []
+        if self.level is not None:
+            commands.append(('set', self.level))
+        elif self.delta is not None:
+            commands.append(('delta', self.delta))
+        if self.mute:
+            commands.append((self.mute, 0))
+        if self.refresh:
+            commands.append(('refresh', None))
+        elif self.get:
+            commands.append(('get', None))
+        return commands
 
-    def trigger_recheck(self):
-        self.set_sleep_target(time.now())
-            
-    def run(self):
-        while self.running:
-            if self.sleep(VolumeMonitor.RESOLUTION):
-                self.report_change()
-            
 
 class Termination(Exception): pass
     
 class VolumeController(ThreadPlus):
-    def __init__(self, dirname, options):
+    SLEEP_FADE_TIME = 60.0
+    # Queued commands that a preempting mute may not overtake.
+    MUTE_BARRIERS = ('mute', 'unmute', 'fade', 'sleep')
+    MIXER_RETRY_DELAY = 0.5
+    UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+    def __init__(self, zones, name, db, options, cardnum=None):
         super(VolumeController, self).__init__()
         self.running = True
+        self.zones = zones
+        self.name = name
         self.emulate = options.emulate
-        self.db = DB("%s/db/player.db" % dirname)
-        self.hw_interface = HWInterface(self.db)
-        self.monitor = None if self.emulate else VolumeMonitor(self)
-        self.queue = Queue.Queue()
+        self.db = db
+        self.max_age = options.max_age
+        self.state_version = 0
+        self.reported_version = 0
+        self.verified_at = 0
+        self.traces = []
+        self.ramp_traces = []
+        self.hw_interface = HWInterface(self.db, options, cardnum)
+        restored = self.restore(zones.snapshot and
+                                zones.snapshot.saved(name))
+        deferred = options.fast_start or restored
+        if deferred:
+            # Answer from the persisted state until the monitor has
+            # checked it against the hardware.
+            self.verified_at = time.time()
+        if self.emulate:
+            self.monitor = None
+        else:
+            self.monitor = VolumeMonitor(self, not options.poll, deferred)
+        # The queue itself is unbounded, but process_message() admits
+        # no more than queue_size commands to it: beyond that, commands
+        # are merged into one entry per connection, or refused.
+        self.queue = gevent.queue.Queue()
+        self.queue_size = options.queue_size
+        self.merged = {}
+        self.barriers = 0
+        self.setting = {}       # Queued volume changes, by socket
+        self.errors = []        # Error responses yet to be sent
+        self.mute_lock = threading.Lock()
         self.volume_re = re.compile("^ *vol *([+-])? *([0-9]+)? *$",
                                     re.IGNORECASE)
         self.mute_re = re.compile("^ *(Un)?Mute *$", re.IGNORECASE)
         self.quit_re = re.compile("^ *q(uit)? *$", re.IGNORECASE)
         self.watch_re = re.compile("^ *watch *$", re.IGNORECASE)
+        self.fade_re = re.compile(
+            "^ *fade +([0-9]+) +([0-9]+(?:\\.[0-9]+)?) *(ms|s|m|h)? *$",
+            re.IGNORECASE)
+        self.sleep_re = re.compile(
+            "^ *sleep +(off|([0-9]+(?:\\.[0-9]+)?) *(s|m|h)?) *$",
+            re.IGNORECASE)
+        self.refresh_re = re.compile("^ *refresh *$", re.IGNORECASE)
+        self.sim_re = re.compile("^ *sim +(timeout|error|change) *$",
+                                 re.IGNORECASE)
+        self.proto_re = re.compile("^ *proto(col)? +(text|json) *$",
+                                   re.IGNORECASE)
+        self.trace_re = re.compile("^ *trace *$", re.IGNORECASE)
+        self.ramp = VolumeRamp(options.max_rate)
+        self.ramp_setters = {}
+        self.ramp_queued = []
+        self.sleep_level = None
         self.watchers = {}
-        self.watcher_lock = threading.Lock()
+        self.watcher_lock = threading.RLock()
+        self.group = None
         self.start()
 
+    def restore(self, saved):
+        """Start from the state in our snapshot, if it was taken with the
+        same hardware.  Return True if it was."""
+        if not saved or saved.get('hardware') != self.hw_interface.signature():
+            return False
+        self.hw_interface.restore_curves(saved.get('curves', []))
+        self.record_state(saved['level'], saved['mute'], False)
+        return True
+
+    def snapshot_state(self):
+        return {'hardware': self.hw_interface.signature(),
+                'level': int(self.db.level),
+                'mute': self.db.mute == 'True',
+                'curves': self.hw_interface.saved_curves()}
+
     def parse_message(self, message):
         match = self.volume_re.match(message)
         cmd, val = None, None
@@ -323,290 +2099,1349 @@ class VolumeController(ThreadPlus):
                     cmd = 'quit'
                 elif self.watch_re.match(message):
                     cmd = 'watch'
-                #elif self.shutdown_re.match(message):
-                #    cmd = 'shutdown'
+                elif self.refresh_re.match(message):
+                    cmd = 'refresh'
+                elif (self.sim_re.match(message) and
+                      self.hw_interface.simulated()):
+                    cmd = 'sim'
+                    val = self.sim_re.match(message).group(1).lower()
+                elif self.proto_re.match(message):
+                    cmd = 'proto'
+                    val = self.proto_re.match(message).group(2).lower()
+                elif self.trace_re.match(message):
+                    cmd = 'trace'
+                else:
+                    cmd, val = self.parse_timed_message(message)
                     
         if DEBUG:
             print ("PARSED CMD: %s, VAL: %s (message: \"%s\")" %
                    (cmd, val, message))
         return (cmd, val)
         
-    def process_message(self, socket, message):
+    def duration(self, value, unit, default_unit):
+        return (float(value) *
+                VolumeController.UNITS[(unit or default_unit).lower()])
+
+    def parse_timed_message(self, message):
+        """Parse the fade and sleep commands:
+          fade <level> <duration>[ms|s|m|h]   (default unit: seconds)
+          sleep <delay>[s|m|h]                (default unit: minutes)
+          sleep off"""
+        match = self.fade_re.match(message)
+        if match:
+            return 'fade', (int(match.group(1)),
+                            self.duration(match.group(2), match.group(3),
+                                          's'))
+        match = self.sleep_re.match(message)
+        if match:
+            if match.group(2):
+                return 'sleep', self.duration(match.group(2),
+                                              match.group(3), 'm')
+            return 'sleep', None
+        return None, None
+
+    def process_message(self, sock, message, trace=None, admitted=True):
+        """Queue a single command.  A proto command takes effect at once,
+        so that the next message is read using the new protocol, and is
+        answered with the current status.  A mute or query may be
+        handled at once (see can_preempt()).  Commands that were not
+        admitted, as their connection has exceeded its quota, are merged
+        into a single queued entry, or refused if they cannot be."""
         if DEBUG:
-            print "PROCESSING MSG: \"%s\"" % message
+            print "PROCESSING MSG: \"%s\" (zone %s)" % (message, self.name)
         cmd, val = self.parse_message(message)
-        self.queue.put((socket, cmd, val, message))
-            
+        if cmd == 'proto':
+            sock.protocol = val
+            cmd = 'get'
+        if trace:
+            trace.mark('parsed', "%s: %s" % (self.name, cmd))
+        METRICS.count('volumed_commands_total', (('zone', self.name),))
+        request = (sock, cmd, val, message, time.time(), trace)
+        if (admitted and cmd in ('mute', 'get') and
+            self.can_preempt(cmd, sock)):
+            self.preempt(request)
+            return
+        if cmd in MergedCommands.CMDS and (sock in self.merged or
+                                           not admitted):
+            # Once merging has begun, the connection's commands go into
+            # its merged entry until that is dequeued, so that they are
+            # applied in the order sent.
+            self.merge(request)
+            return
+        if not admitted and cmd != 'quit':
+            self.reject(request)
+            return
+        if self.queue_size and self.queue.qsize() >= self.queue_size:
+            if cmd in MergedCommands.CMDS:
+                self.merge(request)
+            else:
+                self.reject(request)
+            return
+        # Later commands must follow this one.
+        self.merged.pop(sock, None)
+        if cmd in VolumeController.MUTE_BARRIERS:
+            self.barriers += 1
+        elif cmd in ('set', 'delta'):
+            self.setting[sock] = self.setting.get(sock, 0) + 1
+        self.queue.put(request)
+
+    def can_preempt(self, cmd, sock):
+        """Whether cmd may be handled at once, overtaking any queued
+        commands and volume write in progress.  It may not overtake a
+        queued mute, unmute, fade or sleep, as that would change the net
+        result.  A query may not overtake a volume change, whether
+        queued by its own connection or waiting to be written, and must
+        be answerable from our record of the state.  A mute must not be
+        undone by a volume write, as it would be if mpd (which mutes by
+        setting the volume to zero) controls the volume."""
+        if self.barriers:
+            return False
+        if cmd == 'get':
+            return (sock not in self.setting and
+                    sock not in self.merged and
+                    self.ramp.target is None and not self.ramp_setters and
+                    self.state_fresh())
+        return self.emulate or self.hw_interface.use_mixer()
+
+    def preempt(self, request):
+        """Handle a mute or query from the connection's own greenlet,
+        without waiting for the controller to finish any volume write."""
+        sock, cmd, val, message, queued_at, trace = request
+        if DEBUG:
+            print "PREEMPTING: \"%s\" (zone %s)" % (message, self.name)
+        METRICS.count('volumed_commands_preempted_total',
+                      (('zone', self.name), ('lane', cmd)))
+        traces = []
+        if trace:
+            trace.mark('preempted')
+            traces = [(sock, trace)]
+        if cmd == 'mute':
+            self.cancel_fade()
+            self.try_mixer(self.set_mute, True)
+        self.send_responses([sock], traces)
+        self.observe_latency([queued_at])
+
+    def merge(self, request):
+        """Add a command to its connection's merged entry, queueing a
+        new entry if it has none.  New entries are queued even when the
+        queue is full, as there can be no more than one per connection."""
+        sock, cmd, val, message, queued_at, trace = request
+        merged = self.merged.get(sock)
+        if cmd in ('mute', 'unmute') and not (merged and merged.mute):
+            # The merged entry will stand for one more barrier.
+            self.barriers += 1
+        if merged:
+            merged.add(cmd, val)
+            if trace:
+                trace.mark('merged')
+            METRICS.count('volumed_commands_merged_total',
+                          (('zone', self.name),))
+            return
+        merged = MergedCommands()
+        merged.add(cmd, val)
+        self.merged[sock] = merged
+        self.queue.put((sock, 'merged', merged, message, queued_at, trace))
+
+    def reject(self, request):
+        """Refuse a command, telling the client so once VolumeZones has
+        passed on the rest of its message (see send_errors())."""
+        sock, cmd, val, message, queued_at, trace = request
+        if DEBUG:
+            print "REJECTED: \"%s\" (zone %s)" % (message, self.name)
+        METRICS.count('volumed_commands_rejected_total',
+                      (('zone', self.name),))
+        self.add_error(sock, message, trace, 'rate limited')
+
+    def add_error(self, sock, message, trace, error='unknown command'):
+        """Queue an error response for send_errors().  Errors of the
+        same kind for the same socket are combined into one response."""
+        traces = [(sock, trace)] if trace else []
+        for entry in self.errors:
+            if entry[0] is sock and entry[1] == error:
+                entry[2].append(message)
+                entry[3].extend(traces)
+                return
+        self.errors.append((sock, error, [message], traces))
+
+    def send_errors(self):
+        errors, self.errors = self.errors, []
+        for sock, error, messages, traces in errors:
+            self.send([sock], self.compose_error(messages,
+                                                 self.protocol(sock),
+                                                 error),
+                      False, traces=traces)
+
+    def protocol(self, sock):
+        return getattr(sock, 'protocol', 'text')
+
+
+    def stop(self):
+        super(VolumeController, self).stop()
+        # Wake up get(), which will return None.
+        self.queue.put(None)
+
     def get(self, block=True, timeout=None):
-        # Safe version of get.
-        if block and timeout is None:
-            while self.running:
-                try:
-                    res = self.queue.get(True, ThreadPlus.RESOLUTION)
-                    return res
-                except Queue.Empty:
-                    pass
-        else:
-            res = self.queue.get(block, timeout)
-            return res
+        return self.queue.get(block, timeout)
         
-    def get_requests(self):
+    def get_requests(self, timeout=None):
         """Compile all outstanding requests into a single list to
         process.  Each list entry is a tuple of the form: (conduit,
-        request_string)"""
-        request = self.get()
+        request_string).  If timeout is given, and no requests arrive in
+        that many seconds, return None."""
+        try:
+            request = self.get(True, timeout)
+        except gevent.queue.Empty:
+            return None
         if request:
             requests = [request]
             while not self.queue.empty():
-                requests.append(self.get(False))
+                request = self.get(False)
+                if request:
+                    requests.append(request)
+            for request in requests:
+                if request[1] in ('set', 'delta'):
+                    count = self.setting.pop(request[0], 0) - 1
+                    if count > 0:
+                        self.setting[request[0]] = count
+            requests = self.expand_merged(requests)
+            for request in requests:
+                if request[5]:
+                    request[5].mark('dequeued')
+            METRICS.observe('volumed_batch_size', len(requests))
             return requests
 
-    def add_socket(self, current, socket):
-        if socket in current:
-            current[socket] += 1
+    def expand_merged(self, requests):
+        """Replace each merged entry with the commands that it stands
+        for.  Commands arriving from now on are queued afresh."""
+        expanded = []
+        for request in requests:
+            sock, cmd, val, message, queued_at, trace = request
+            if cmd != 'merged':
+                expanded.append(request)
+                continue
+            if self.merged.get(sock) is val:
+                del self.merged[sock]
+            for merged_cmd, merged_val in val.commands():
+                expanded.append((sock, merged_cmd, merged_val, message,
+                                 queued_at, trace))
+                # Trace only the first.
+                trace = None
+        return expanded
+
+    def add_socket(self, current, sock):
+        if sock in current:
+            current[sock] += 1
         else:
-            current[socket] = 1
+            current[sock] = 1
         return current
 
-    def send(self, sockets, msg):
-        for socket in sockets:
+    def remove_socket(self, sock):
+        """Forget a socket that has been closed or evicted."""
+        with self.watcher_lock:
+            self.watchers.pop(sock, None)
+        self.merged.pop(sock, None)
+        self.setting.pop(sock, None)
+
+    def send(self, sockets, msg, status=True, broadcast=False,
+             traces=None):
+        """Queue msg for sending to each socket.  If msg is None, the
+        sockets are closed once their queued messages have been
+        sent.  A broadcast is traced for all of the traced commands
+        being processed, and a reply for those of the given (socket,
+        trace) pairs (by default, the current batch's) from the
+        socket."""
+        if traces is None:
+            traces = self.traces
+        for sock in sockets:
             if msg and self.running:
-                if DEBUG:
-                    sys.stdout.write("SENDING MESSAGE: \"%s\"..." %
-                                     msg.strip())
-                try:
-                    socket.send(msg)
-                    if DEBUG:
-                        print "SENT"
-                except Exception:
-                    # Assume the socket was closed, not much we can do.
-                    if DEBUG:
-                        print ""
-                    sys.stderr.write("Send failed.  Msg: \"%s\".\n" %
-                                     msg.strip())
-                    try:
-                        socket.close()
-                    except Exception:
-                        pass
+                if broadcast:
+                    sent = [(trace, 'broadcast')
+                            for owner, trace in self.active_traces()]
+                else:
+                    sent = [(trace, 'reply') for owner, trace in traces
+                            if owner is sock]
+                self.zones.writer(sock).put(msg, status and self.name,
+                                            sent)
             else:
-                socket.close()
+                self.zones.writer(sock).close()
+
+    def active_traces(self):
+        """The (socket, trace) pairs of the traced commands being
+        processed, including those waiting on a volume write.  Work done
+        for the volume monitor is not traced."""
+        if threading.current_thread() is not self:
+            return []
+        return self.traces + self.ramp_traces
+
+    def mark_traces(self, event, detail=None):
+        for sock, trace in self.active_traces():
+            trace.mark(event, detail)
+
+    def hw_call(self, op, *args):
+        """Call the hardware interface, tracing the call."""
+        self.mark_traces('hw_call', op)
+        try:
+            return getattr(self.hw_interface, op)(*args)
+        finally:
+            self.mark_traces('hw_done', op)
 
     def report_change(self):
         if self.monitor:
             self.monitor.report_change()
+        elif self.state_version != self.reported_version:
+            # When emulating there is no monitor, so tell the watchers
+            # about our own changes ourselves.
+            self.reported_version = self.state_version
+            self.update_watchers(*self.get_volume())
                 
+    def record_state(self, level, mute, verified=True):
+        """Record the volume and mute state, bumping the state version if
+        it has changed.  If verified, the state is known to match the
+        hardware as of now."""
+        version = self.state_version
+        if level != int(self.db.level):
+            self.db.level = level
+            self.state_version += 1
+        if mute != (self.db.mute == 'True'):
+            self.db.mute = 'True' if mute else 'False'
+            self.state_version += 1
+        if self.state_version != version:
+            if self.zones.snapshot:
+                self.zones.snapshot.changed()
+            if self.active_traces():
+                self.mark_traces('db_update')
+                self.db.trace_commit(
+                    [trace for sock, trace in self.active_traces()])
+        if verified:
+            self.verified_at = time.time()
+
+    def state_fresh(self):
+        return self.emulate or time.time() - self.verified_at < self.max_age
+
     def set_mute(self, mute=True):
-        if not self.emulate:
-            self.hw_interface.set_mute(mute)
-        self.db.mute = 'True' if mute else 'False'
+        # Mutes may be made from a connection's greenlet (see preempt()),
+        # so make sure that they are applied in the order asked for.
+        with self.mute_lock:
+            if not self.emulate:
+                self.hw_call('set_mute', mute)
+            self.record_state(int(self.db.level), mute)
         self.report_change()
 
     def correct_volume(self, vol, writing):
-        """Stub for doing volume curve correction.  Currently this does
-        nothing.
-
-        Note that it *must* work so that: 
-          self.correct_volume(self.correct_volume(vol, False), True))
-        is equal to:
-          vol
-        and also to: 
+        """Apply volume curve correction.  When writing, vol is a
+        percentage and the raw hardware value is returned.  When
+        reading, vol is a raw hardware value and the percentage is
+        returned.  See VolumeCurve for the guarantees that this makes:
           self.correct_volume(self.correct_volume(vol, True), False))
-
-        Note that when reading and writing volume data from/to the
-        hardware interface, it will probably be better to read/write the
-        absolute volume level rather than using percentages.  No
-        provision has currently been made to do this.  You will need to
-        modify the `cmd' variables in HWInterface.get_volume() and
-        HWInterface.set_volume() in order to do this."""
-        return vol
+        is equal to vol for any percentage, and
+          self.correct_volume(self.correct_volume(vol, False), True))
+        is equal to vol for any raw value that we have written."""
+        curve = self.hw_interface.curve()
+        if writing:
+            return curve.to_raw(vol)
+        return curve.to_pct(vol)
         
-    def get_volume(self):
-        if not self.emulate:
-            vol, mute = self.hw_interface.get_volume()
-            self.db.level = self.correct_volume(vol, False)
-            self.db.mute = 'True' if mute else 'False'
-        return self.db.level, self.db.mute == 'True'
+    def get_volume(self, refresh=False):
+        """Return the current (volume, mute) state.  This comes from our
+        in-memory record, which our own writes and the volume monitor
+        keep current, unless the record is older than max_age seconds
+        or refresh is set, in which case the hardware is read."""
+        if refresh or not self.state_fresh():
+            if not self.emulate:
+                vol, mute = self.hw_call('get_volume')
+                self.record_state(self.correct_volume(vol, False), mute)
+        return int(self.db.level), self.db.mute == 'True'
 
-    def set_volume(self, vol):
+    def limit_volume(self, vol):
         max_pct = int(self.db.max_pct)
 
         if vol < 0:
             vol = 0
         elif vol > max_pct:
             vol = max_pct
+        return vol
 
-        vol = self.correct_volume(vol, True)
-
+    def set_volume(self, vol):
+        vol = self.limit_volume(vol)
         if not self.emulate:
-            self.hw_interface.set_volume(vol)
-        self.db.level = vol
+            self.hw_call('set_volume', self.correct_volume(vol, True))
+        self.record_state(vol, self.db.mute == 'True')
         self.report_change()
 
-    def compose_response(self, vol, mute):
-        return "Vol: %s, Mute: %s\n" % (vol, 'on' if mute else 'off')
-        
-    def send_responses(self, sockets):
-        self.send(sockets,
-                  self.compose_response(self.db.level, self.db.mute == 'True'))
+    def compose_response(self, vol, mute, protocol='text'):
+        # The state version increases each time the volume or mute
+        # state changes, so json clients can discard stale updates.
+        # Responses for zones other than the default are labelled with
+        # their zone.
+        if protocol == 'json':
+            response = {'seq': self.state_version,
+                        'vol': int(vol), 'mute': mute}
+            if self.name != VolumeZones.DEFAULT:
+                response['zone'] = self.name
+            return json.dumps(response, separators=(',', ':'),
+                              sort_keys=True)
+        response = "Vol: %s, Mute: %s\n" % (vol, 'on' if mute else 'off')
+        if self.name != VolumeZones.DEFAULT:
+            response = "Zone: %s, %s" % (self.name, response)
+        return response
+
+    def compose_error(self, messages, protocol='text',
+                      error='unknown command'):
+        """Compose a single response refusing each of messages: in the
+        json protocol, one object whose cmd separates them as a message
+        of several commands would; otherwise, one line for each."""
+        if protocol == 'json':
+            return json.dumps({'error': error, 'cmd': '; '.join(messages)},
+                              separators=(',', ':'), sort_keys=True)
+        return '\n'.join(["%s: \"%s\"" % (error.capitalize(), message)
+                          for message in messages])
+
+    def send_status(self, sockets, vol, mute, broadcast=False,
+                    traces=None):
+        """Send the given state to each socket, in its own protocol."""
+        by_protocol = {}
+        for sock in sockets:
+            by_protocol.setdefault(self.protocol(sock), []).append(sock)
+        for protocol, group in by_protocol.items():
+            self.send(group, self.compose_response(vol, mute, protocol),
+                      broadcast=broadcast, traces=traces)
+
+    def send_responses(self, sockets, traces=None):
+        self.send_status(sockets, self.db.level, self.db.mute == 'True',
+                         traces=traces)
                 
+    def send_queries(self, sockets):
+        """Answer status requests with the volume that the ramp is
+        heading for, which may not have been written yet."""
+        self.send_status(sockets, self.ramp_level(), self.db.mute == 'True')
+
+    def ramp_level(self):
+        """The level that the volume is heading towards."""
+        if self.ramp.target is not None:
+            return self.ramp.target
+        return int(self.db.level)
+
+    def apply_ramp(self, force=False):
+        """Make any volume write that the ramp says is now due (or, if
+        force is set, that it has waiting), and start the sleep fade-out
+        if the sleep timer has expired."""
+        now = time.time()
+        if self.ramp.sleep_at is not None and now >= self.ramp.sleep_at:
+            self.ramp.sleep_at = None
+            self.sleep_level = int(self.db.level)
+            self.ramp.start_fade(self.sleep_level, 0,
+                                 VolumeController.SLEEP_FADE_TIME, now)
+        level = self.ramp.next_level(now, force)
+        if level is None:
+            return
+        try:
+            self.set_volume(level)
+        except MixerError:
+            # Make sure that the write is retried.  A fade will simply
+            # carry on from wherever it has got to by then.
+            if self.ramp.idle():
+                self.ramp.set_target(level)
+            raise
+        self.ramp.written(level, time.time())
+        if self.ramp.target is None:
+            self.send_responses(self.ramp_setters, self.ramp_traces)
+            self.ramp_setters = {}
+            self.observe_latency(self.ramp_queued)
+            self.ramp_queued = []
+            self.ramp_traces = []
+        if self.ramp.idle() and self.sleep_level is not None:
+            self.finish_sleep()
+
+    def finish_sleep(self):
+        """The sleep fade-out is complete: mute, and put the volume back
+        to where it was so that unmuting restores it."""
+        level, self.sleep_level = self.sleep_level, None
+        self.set_mute(True)
+        if self.hw_interface.use_mixer() and not self.emulate:
+            self.hw_call('set_volume', self.correct_volume(level, True))
+        self.record_state(level, True)
+        self.ramp.written(level, time.time())
+        self.report_change()
+
+    def cancel_fade(self):
+        # Any explicit volume or mute change overrides a fade,
+        # including a sleep fade-out.
+        self.ramp.cancel_fade()
+        self.sleep_level = None
+
+    def start_fade(self, level, duration):
+        self.cancel_fade()
+        self.ramp.start_fade(int(self.db.level), self.limit_volume(level),
+                             duration, time.time())
+
+    def set_sleep(self, delay):
+        if delay is None:
+            self.ramp.sleep_at = None
+        else:
+            self.ramp.sleep_at = time.time() + delay
+        self.cancel_fade()
+
+    def try_mixer(self, action, *args):
+        """Call action, reporting rather than raising any mixer error, so
+        that requests are still answered (with our record of the state)
+        when the hardware fails."""
+        try:
+            action(*args)
+        except MixerError as e:
+            METRICS.count('volumed_mixer_errors_total')
+            sys.stderr.write("Mixer error: %s\n" % e)
+            self.verified_at = 0
+
+    def observe_latency(self, queued):
+        """Record the time taken to answer commands queued at the given
+        times."""
+        now = time.time()
+        for queued_at in queued:
+            METRICS.observe('volumed_command_seconds', now - queued_at)
+
     def process_requests(self, requests):
-        vol = int(self.db.level)
+        """Process a batch of commands in three lanes:
+
+          - the mute lane: the net result of the mute and unmute
+            commands is applied first (and a mute need not even wait
+            for that, see preempt());
+          - the query lane: status requests are then answered from our
+            record of the state, without waiting for the hardware
+            (unless a refresh was asked for), giving the volume that
+            we are heading for so that they reflect any volume changes
+            before them;
+          - the volume lane: volume changes are coalesced into the
+            ramp's target, which run() writes at the ramp's rate.
+
+        An unmute may not overtake a pending volume decrease, which is
+        written first, so that the result is never louder than the
+        commands asked for."""
+        vol = self.ramp_level()
         set = False
         setters = {}
-        get = False
+        refresh = False
+        verify = False
         getters = {}
-        mute = False
+        mute = None
         muters = {}
-        unmute = False
-        unmuters = {}
         quit = False
         quitters = {}
-        for socket, cmd, val, msg in requests:
+        now = time.time()
+        answered = []
+        set_queued = []
+        set_traces = []
+        self.traces = []
+        for sock, cmd, val, msg, queued_at, trace in requests:
             if DEBUG:
                 print "PROCESSING CMD: \"%s\" (VAL: %s)" % (cmd, val)
-            if cmd == 'get':
-                get = True
-                getters = self.add_socket(getters, socket)
+            METRICS.observe('volumed_queue_wait_seconds', now - queued_at)
+            if cmd in ('set', 'delta'):
+                set_queued.append(queued_at)
+            elif cmd != 'watch':
+                answered.append(queued_at)
+            if trace:
+                trace.mark('batch', len(requests))
+                if cmd in ('set', 'delta'):
+                    set_traces.append((sock, trace))
+                else:
+                    self.traces.append((sock, trace))
+            if cmd in ('get', 'refresh'):
+                refresh = refresh or cmd == 'refresh'
+                getters = self.add_socket(getters, sock)
             elif cmd == 'set':
                 set = True
                 vol = val
-                setters = self.add_socket(setters, socket)
+                setters = self.add_socket(setters, sock)
             elif cmd == 'delta':
                 set = True
                 vol += val
-                setters = self.add_socket(setters, socket)
-            elif cmd == 'mute':
-                mute = True 
-                unmute = False
-                muters = self.add_socket(muters, socket)
-            elif cmd == 'unmute':
-                unmute = True 
-                mute = False
-                unmuters = self.add_socket(unmuters, socket)
+                setters = self.add_socket(setters, sock)
+            elif cmd in ('mute', 'unmute'):
+                # The last of these wins.
+                mute = cmd == 'mute'
+                muters = self.add_socket(muters, sock)
             elif cmd == 'quit':
                 quit = True
-                quitters = self.add_socket(quitters, socket)
+                quitters = self.add_socket(quitters, sock)
             elif cmd == 'watch':
                 with self.watcher_lock:
-                    self.watchers = self.add_socket(self.watchers, socket)
+                    self.watchers = self.add_socket(self.watchers, sock)
+            elif cmd == 'fade':
+                # The fade overrides any earlier volume changes in this
+                # batch, so those setters just get the current status.
+                self.start_fade(*val)
+                set = False
+                answered.extend(set_queued)
+                set_queued = []
+                self.traces.extend(set_traces)
+                set_traces = []
+                for setter in setters:
+                    getters = self.add_socket(getters, setter)
+                setters = {}
+                getters = self.add_socket(getters, sock)
+            elif cmd == 'sleep':
+                self.set_sleep(val)
+                getters = self.add_socket(getters, sock)
+            elif cmd == 'sim':
+                self.hw_interface.mixer.inject(val)
+                getters = self.add_socket(getters, sock)
+            elif cmd == 'trace':
+                self.send([sock], json.dumps({'traces': TRACER.dump()},
+                                             sort_keys=True), False)
             else:
-                socket.send("Unknown command: \"%s\"" % msg)
-        if mute:
-            self.set_mute(True)
-            self.send_responses(muters)
+                self.add_error(sock, msg, trace)
+        self.send_errors()
         if set:
-            self.set_volume(vol)
-            self.send_responses(setters)
-        if unmute:
-            self.set_mute(False)
-            self.send_responses(unmuters)
-        if get:
-            self.get_volume()
-            self.send_responses(getters)
+            # Setters are answered once their volume has been written,
+            # which may be a little later if we are rate limiting.
+            self.cancel_fade()
+            self.ramp.set_target(self.limit_volume(vol))
+            for sock in setters:
+                self.ramp_setters = self.add_socket(self.ramp_setters,
+                                                    sock)
+            self.ramp_queued.extend(set_queued)
+            self.ramp_traces.extend(set_traces)
+        if mute is not None:
+            self.cancel_fade()
+            if (not mute and self.ramp.target is not None and
+                self.ramp.target < int(self.db.level)):
+                self.try_mixer(self.apply_ramp, True)
+            self.try_mixer(self.set_mute, mute)
+            self.send_responses(muters)
+        if getters:
+            verify = not refresh and not self.state_fresh()
+            if refresh:
+                self.try_mixer(self.get_volume, True)
+            self.send_queries(getters)
+        self.observe_latency(answered)
+        if verify:
+            # Now that the getters have been answered, check our record
+            # against the hardware, correcting them if it was wrong.
+            version = self.state_version
+            self.try_mixer(self.get_volume, True)
+            if self.state_version != version:
+                self.send_queries(getters)
         if quit:
             self.send(quitters, None)
+        self.traces = []
 
     def update_watchers(self, vol, mute):
         with self.watcher_lock:
-            watchers = self.watchers
-
-        msg = self.compose_response(vol, mute)
-        ok_watchers = {}
-        for w in watchers:
-            try:
-                w.send(msg)
-                ok_watchers[w] = 1
-            except Exception as e:
-                try:
-                    w.close()
-                except Exception:
-                    pass
-        with self.watcher_lock:
-            self.watchers = ok_watchers
+            watchers = self.watchers.keys()
+        self.send_status(watchers, vol, mute, True)
+        if self.group:
+            self.group.update(vol, mute)
         
     def run(self):
         # This is where we asynchronously parse and process commands
         # read from our input stream.  Note that although this is
         # asynchronous with regard to the input stream, the command
         # stream is single-threaded.
+        deferred = False
         try:
             while self.running:
-                requests = self.get_requests()
-                if requests and self.running:
-                    #print "REQUESTS: %s" % (requests,)
-                    self.process_requests(requests)
+                requests = self.get_requests(self.ramp.delay(time.time()))
+                try:
+                    if requests and self.running:
+                        #print "REQUESTS: %s" % (requests,)
+                        try:
+                            self.process_requests(requests)
+                        finally:
+                            self.barriers -= len(
+                                [request for request in requests
+                                 if request[1] in
+                                 VolumeController.MUTE_BARRIERS])
+                    # A volume write gives way to any newly queued
+                    # commands, so that a mute is not held up behind it,
+                    # but only once in a row, so that writes cannot be
+                    # starved.
+                    if self.running and (deferred or self.queue.empty()):
+                        deferred = False
+                        self.apply_ramp()
+                    else:
+                        deferred = True
+                except MixerError as e:
+                    METRICS.count('volumed_mixer_errors_total')
+                    # Don't trust our record of the hardware state, and
+                    # give the hardware a moment before retrying any
+                    # outstanding write.
+                    sys.stderr.write("Mixer error: %s\n" % e)
+                    self.verified_at = 0
+                    time.sleep(VolumeController.MIXER_RETRY_DELAY)
         except Termination:
             print "TERMINATING"
         
         if self.monitor:
             self.monitor.stop()
             self.monitor.join()
+        self.hw_interface.close()
+        self.db.close()
+        stats = self.db.stats()
+        if stats:
+            print stats
 
-class SingleVolumeController(Singleton):
-    """This creates a Singleton instance of the VolumeServer class.
-    There is probably a more elegant way of doing this but this appears
-    to work.  We need this because we want to serialise our access to
-    both the database and hardware, and each VolumeServer instance needs
-    to be able to find this."""
-    def __init__(self, *args):
-        if not '_vc' in self.__dict__:
-            self._vc = VolumeController(*args)
+class VolumeZones(Singleton):
+    """The set of zones that we control, each with its own card, mixer
+    control, state and VolumeController, so that zones run in parallel.
+    The default zone is the one configured in moode's database; other
+    zones are given by --zone options.  This is a Singleton so that each
+    VolumeServer instance can find it.
 
-    def __getattr__(self, name):
-        if name != '_vc':
-            return self._vc.__getattribute__(name)
-            
-    def __setattr__(self, name, value):
-        if name == '_vc':
-            self.__dict__[name] = value
+    A connection starts out using the default zone (or, for websockets,
+    the zone named by the url path, eg ws://host:8888/kitchen).  The
+    command "zone name" changes the connection's zone, and a command
+    may be sent to a specific zone by prefixing it with @name.  The
+    zones also share a single SocketWriter per connection."""
+    DEFAULT = 'default'
+
+    def __init__(self, options=None):
+        if 'controllers' in self.__dict__:
+            return
+        self.zone_re = re.compile("^ *zone +(\\S+) *$", re.IGNORECASE)
+        self.prefix_re = re.compile("^ *@(\\S+) +(.*)$")
+        self.writers = {}
+        self.buckets = {}
+        self.client_rate = options.client_rate
+        self.client_burst = options.client_burst
+        self.lock = threading.RLock()
+        self.controllers = {}
+        self.snapshot = None
+        if options.state_file:
+            self.snapshot = StateSnapshot(options.state_file)
+        db = DB(options.db, wal=options.wal)
+        self.controllers[VolumeZones.DEFAULT] = VolumeController(
+            self, VolumeZones.DEFAULT, db, options)
+        for name, card, control, max_pct in options.zones:
+            self.controllers[name] = VolumeController(
+                self, name, ZoneSettings(control, max_pct), options, card)
+        if self.snapshot:
+            for name, controller in self.controllers.items():
+                self.snapshot.register(name, controller.snapshot_state)
+        self.group = None
+        if options.members:
+            # The default zone leads the group.
+            leader = self.controllers[VolumeZones.DEFAULT]
+            self.group = VolumeGroup(leader, options.members)
+            leader.group = self.group
+        METRICS.gauge('volumed_watchers', lambda: [
+            ((('zone', name),), len(controller.watchers))
+            for name, controller in self.controllers.items()])
+        METRICS.gauge('volumed_connections',
+                      lambda: [((), len(self.writers))])
+
+    def controller(self, name):
+        return self.controllers.get(name or VolumeZones.DEFAULT)
+
+    def process_message(self, sock, message, trace=None):
+        """Pass each command in message to the controller of its zone.
+        Connections using the json protocol may send several commands in
+        one message, separated by semicolons or newlines."""
+        if getattr(sock, 'protocol', 'text') == 'json':
+            messages = [msg.strip() for msg in re.split('[;\n]', message)]
+            messages = [msg for msg in messages if msg]
         else:
-            self._vc.__dict__[name] = value
-            
+            messages = [message]
+        traces = TRACER.split(trace, len(messages))
+        used = []
+        for message, trace in zip(messages, traces):
+            admitted = self.admit(sock)
+            original = message
+            zone = getattr(sock, 'zone', None)
+            match = self.prefix_re.match(message)
+            if match:
+                zone, message = match.group(1), match.group(2)
+            else:
+                match = self.zone_re.match(message)
+                if match and self.controller(match.group(1)):
+                    # Answer with the status of the new zone.
+                    zone = sock.zone = match.group(1)
+                    message = 'vol'
+            controller = self.controller(zone)
+            if not controller:
+                # Unknown zones are reported as unknown commands.
+                controller, message = self.controller(None), original
+            controller.process_message(sock, message, trace, admitted)
+            if controller not in used:
+                used.append(controller)
+        # Any commands refused are answered together.
+        for controller in used:
+            controller.send_errors()
+
+    def admit(self, sock):
+        """Return True if a command from socket is within its
+        connection's quota."""
+        if not self.client_rate:
+            return True
+        with self.lock:
+            bucket = self.buckets.get(sock)
+            if not bucket:
+                bucket = TokenBucket(self.client_rate, self.client_burst)
+                self.buckets[sock] = bucket
+            return bucket.take()
+
+    def writer(self, sock):
+        with self.lock:
+            writer = self.writers.get(sock)
+            if not writer:
+                writer = SocketWriter(sock, self.remove_socket)
+                self.writers[sock] = writer
+            return writer
+
+    def remove_socket(self, sock):
+        """Forget a socket that has been closed or evicted."""
+        for controller in self.controllers.values():
+            controller.remove_socket(sock)
+        with self.lock:
+            writer = self.writers.pop(sock, None)
+            self.buckets.pop(sock, None)
+        if writer:
+            writer.stop()
+
+    def stop(self):
+        if self.group:
+            self.group.stop()
+        for controller in self.controllers.values():
+            controller.stop()
+
+    def join(self):
+        if self.group:
+            self.group.join()
+        for controller in self.controllers.values():
+            controller.join()
+        if self.snapshot:
+            self.snapshot.close()
+
+
+class GroupLink(WebSocketClient):
+    """A websocket connection to a follower, using the json protocol."""
+
+    def __init__(self, member):
+        WebSocketClient.__init__(self, member.url,
+                                 protocols=[VolumeServer.JSON_PROTOCOL])
+        self.member = member
+
+    def received_message(self, message):
+        if not message.is_binary:
+            self.member.received(message.data)
+
+    def closed(self, code, reason=None):
+        self.member.disconnected(self)
+
+
+class GroupMember(ThreadPlus):
+    """A follower in our volume group, and our persistent link to it.
+    The follower is sent our state, adjusted by its offset and limited
+    to its max_pct, using the ordinary protocol.  Only one update is in
+    flight at a time: we wait for its reply (or REPLY_TIMEOUT) before
+    sending the next, and a newer state simply replaces an unsent one,
+    so a burst of changes is coalesced and the follower is never more
+    than about one round trip behind.
+
+    We also watch the follower.  A change made there (ie one that is not
+    the reply to an update of ours) is passed to the group, so that it
+    is applied to the leader and every other member."""
+    REPLY_TIMEOUT = 1.0
+    RECONNECT_DELAY = 2.0
+
+    def __init__(self, group, url, offset=0, max_pct=100):
+        super(GroupMember, self).__init__()
+        self.group = group
+        self.url = url
+        self.offset = offset
+        self.max_pct = max_pct
+        self.protocol = 'text'
+        self.link = None
+        self.wanted = None
+        self.sent = None
+        self.known = None
+        self.sent_at = None
+        self.ready = gevent.event.Event()
+        self.start()
+
+    def update(self, vol, mute):
+        """Bring the follower into line with the leader's new state."""
+        self.wanted = (min(max(vol + self.offset, 0), self.max_pct), mute)
+        self.ready.set()
+
+    def received(self, data):
+        try:
+            status = json.loads(data)
+            state = (int(status['vol']), bool(status['mute']))
+        except (ValueError, KeyError, TypeError):
+            return
+        if self.sent_at is not None:
+            # The reply to our update.
+            self.sent_at = None
+            self.known = state
+            self.ready.set()
+        elif state != self.known and state != self.sent:
+            if DEBUG:
+                print "GROUP MEMBER %s CHANGED: %s" % (self.url, state)
+            self.known = state
+            self.group.member_changed(self, *state)
+
+    def disconnected(self, link):
+        if link is self.link:
+            sys.stderr.write("Lost group member %s\n" % self.url)
+            self.link = None
+            self.ready.set()
+
+    def connect(self):
+        link = GroupLink(self)
+        try:
+            link.connect()
+        except Exception as e:
+            if DEBUG:
+                print "Unable to connect to group member %s: %s" % (
+                    self.url, e)
+            return False
+        self.link, self.sent, self.known, self.sent_at = link, None, None, None
+        self.link.send('watch')
+        # Bring the follower up to date.
+        self.ready.set()
+        return True
+
+    def send_update(self):
+        """Send the commands needed to bring the follower to the wanted
+        state, in a single message."""
+        vol, mute = self.wanted
+        cmds = []
+        if self.sent is None or vol != self.sent[0]:
+            cmds.append("vol %d" % vol)
+        if self.sent is None or mute != self.sent[1]:
+            cmds.append('mute' if mute else 'unmute')
+        try:
+            self.link.send('; '.join(cmds))
+        except Exception as e:
+            sys.stderr.write("Send to group member %s failed: %s\n" %
+                             (self.url, e))
+            self.link = None
+            return
+        self.sent, self.sent_at = self.wanted, time.time()
+
+    def run(self):
+        while self.running:
+            if not self.link and not self.connect():
+                self.sleep(GroupMember.RECONNECT_DELAY)
+                continue
+            if self.sent_at is not None:
+                timeout = (self.sent_at + GroupMember.REPLY_TIMEOUT -
+                           time.time())
+                if timeout <= 0:
+                    self.sent_at = None
+                    continue
+                self.ready.wait(timeout)
+            else:
+                self.ready.wait()
+            self.ready.clear()
+            if (self.running and self.link and self.sent_at is None and
+                self.wanted is not None and self.wanted != self.sent):
+                self.send_update()
+        if self.link:
+            self.link.close()
+
+    def stop(self):
+        super(GroupMember, self).stop()
+        self.ready.set()
+
+    # The leader's controller sends replies to the commands that we
+    # pass to it on the follower's behalf; we have no use for them.
+    def send(self, msg):
+        pass
+
+    def close_connection(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class VolumeGroup:
+    """A volume group, led by one of our zones.  Each change to the
+    leader's state is relayed to every follower (see GroupMember), and a
+    change made on a follower is applied to the leader, less the
+    follower's offset, and so relayed to the rest of the group.  The
+    watchers of each volumed in the group hear of every change."""
+
+    def __init__(self, leader, members):
+        self.leader = leader
+        self.state = leader.get_volume()
+        self.members = [GroupMember(self, url, offset, max_pct)
+                        for url, offset, max_pct in members]
+        self.update(*self.state)
+
+    def update(self, vol, mute):
+        self.state = (vol, mute)
+        for member in self.members:
+            member.update(vol, mute)
+
+    def member_changed(self, member, vol, mute):
+        level, leader_mute = self.state
+        if vol - member.offset != level:
+            self.leader.process_message(member, "vol %d" %
+                                        max(vol - member.offset, 0))
+        if mute != leader_mute:
+            self.leader.process_message(member,
+                                        'mute' if mute else 'unmute')
+
+    def stop(self):
+        for member in self.members:
+            member.stop()
+
+    def join(self):
+        for member in self.members:
+            member.join()
+
 
 class VolumeServer(WebSocket):
+    # Clients asking for this websocket sub-protocol get the json
+    # protocol from the start, without sending a proto command.
+    JSON_PROTOCOL = 'volumed-json'
+
     def __init__(self, *args, **kwargs):
         super(VolumeServer, self).__init__(*args, **kwargs)
-        self.vc = SingleVolumeController()
-        
+        self.zones = VolumeZones()
+        self.protocol = 'text'
+        self.zone = None
+
+    def opened(self):
+        if VolumeServer.JSON_PROTOCOL in (self.protocols or []):
+            self.protocol = 'json'
+        path = (self.environ or {}).get('PATH_INFO', '').strip('/')
+        if path and self.zones.controller(path):
+            self.zone = path
+        RECORDER.opened(self, 'ws')
+
     def received_message(self, message):
         if not message.is_binary:
-            self.vc.process_message(self, message.data.strip())
+            trace = TRACER.start()
+            RECORDER.received(self, message.data.strip())
+            self.zones.process_message(self, message.data.strip(), trace)
+
+    def closed(self, code, reason=None):
+        RECORDER.closed(self)
+        self.zones.remove_socket(self)
+
+
+class LineClient:
+    """A client connected through volumed's unix domain socket.  This
+    speaks the same protocol as the websocket interface, one command per
+    line, without the cost of an http upgrade and websocket framing.  It
+    looks enough like a VolumeServer for the controller to treat it the
+    same way."""
+
+    def __init__(self, sock, zones):
+        self.sock = sock
+        self.zones = zones
+        self.protocol = 'text'
+        self.zone = None
+
+    def send(self, msg):
+        if not msg.endswith('\n'):
+            msg += '\n'
+        self.sock.sendall(msg)
+
+    def close_connection(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+    def close(self):
+        self.close_connection()
+
+    def serve(self):
+        RECORDER.opened(self, 'unix')
+        rfile = self.sock.makefile('rb')
+        try:
+            while True:
+                line = rfile.readline()
+                if not line:
+                    break
+                if line.strip():
+                    trace = TRACER.start()
+                    RECORDER.received(self, line.strip())
+                    self.zones.process_message(self, line.strip(), trace)
+        except socket.error:
+            pass
+        RECORDER.closed(self)
+        self.zones.remove_socket(self)
+
+
+def unix_server(path, zones, listener=None):
+    """Create a server listening on a unix domain socket at path, or
+    return None if we cannot.  If listener is given, it is an already
+    listening socket (eg from systemd) to use instead."""
+    if listener:
+        return gevent.server.StreamServer(
+            listener, lambda sock, address: LineClient(sock, zones).serve())
+    try:
+        if os.path.exists(path):
+            os.unlink(path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        # Allow the web server's php scripts to connect.
+        os.chmod(path, 0666)
+        listener.listen(16)
+    except (socket.error, OSError) as e:
+        sys.stderr.write("Unable to listen on %s: %s\n" % (path, e))
+        return None
+    return gevent.server.StreamServer(
+        listener, lambda sock, address: LineClient(sock, zones).serve())
+
+
+SD_LISTEN_FDS_START = 3
+
+def systemd_listeners():
+    """Return the listening sockets passed to us by systemd socket
+    activation (see sd_listen_fds(3)), as a dict of sockets keyed by
+    address family."""
+    try:
+        if int(os.environ.get('LISTEN_PID', 0)) != os.getpid():
+            return {}
+        count = int(os.environ.get('LISTEN_FDS', 0))
+    except ValueError:
+        return {}
+    for name in ('LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES'):
+        os.environ.pop(name, None)
+    listeners = {}
+    for fd in range(SD_LISTEN_FDS_START, SD_LISTEN_FDS_START + count):
+        # The address returned is of the socket's real family, whatever
+        # family we use to wrap it.
+        probe = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+        address = probe.getsockname()
+        probe.close()
+        if isinstance(address, str):
+            family = socket.AF_UNIX
+        elif len(address) == 4:
+            family = socket.AF_INET6
+        else:
+            family = socket.AF_INET
+        listeners[family] = socket.fromfd(fd, family, socket.SOCK_STREAM)
+        os.close(fd)
+    return listeners
+
+
+def card_number(card):
+    """Return the number of the alsa card given by number or by id (as
+    in /proc/asound/cards)."""
+    if card.isdigit():
+        return int(card)
+    try:
+        link = os.readlink("/proc/asound/%s" % card)
+    except OSError:
+        raise ValueError("Unknown alsa card: %s" % card)
+    return int(link.replace('card', ''))
+
+
+def parse_zone(spec):
+    """Parse a --zone option, returning (name, cardnum, control,
+    max_pct)."""
+    match = re.match("^([^=@\\s]+)=([^:]+):([^:]+)(:([0-9]+))?$", spec)
+    if not match or match.group(1) == VolumeZones.DEFAULT:
+        raise ValueError("Invalid zone: %s" % spec)
+    max_pct = int(match.group(5)) if match.group(5) else 100
+    return (match.group(1), card_number(match.group(2)), match.group(3),
+            max_pct)
+
+
+def parse_member(spec):
+    """Parse a --group-member option, returning (url, offset,
+    max_pct)."""
+    match = re.match("^(ws://)?([^/,\\s]+)(/[^,\\s]*)?"
+                     "((,(offset|max)=-?[0-9]+)*)$", spec)
+    if not match:
+        raise ValueError("Invalid group member: %s" % spec)
+    host = match.group(2)
+    if ':' not in host:
+        host += ':8888'
+    settings = dict([setting.split('=')
+                     for setting in match.group(4).split(',') if setting])
+    return ("ws://%s%s" % (host, match.group(3) or ''),
+            int(settings.get('offset', 0)),
+            int(settings.get('max', 100)))
+
+
+def with_metrics(app):
+    """Wrap a WSGI application, serving our metrics at /metrics."""
+    def dispatch(environ, start_response):
+        if (environ.get('PATH_INFO') == '/metrics' and
+            'HTTP_UPGRADE' not in environ):
+            body = METRICS.render()
+            start_response('200 OK',
+                           [('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8'),
+                            ('Content-Length', str(len(body)))])
+            return [body]
+        return app(environ, start_response)
+    return dispatch
 
 
 if __name__ == '__main__':
     import optparse
-    import os
     import signal
 
     parser = optparse.OptionParser()
     parser.add_option(
         "-p", "--port", type=int, dest="port", default=8888,
-        help="Run volumed server using specified port (default 888)")
+        help="Run volumed server using specified port (default 8888)")
     parser.add_option("-e", "--emulate",  dest="emulate",
                       action="store_true", help="Emulate the hw interface")
+    parser.add_option(
+        "--mpd-host", dest="mpd_host", default='localhost',
+        help="Connect to mpd on host, or unix socket path (default localhost)")
+    parser.add_option(
+        "--mpd-port", type=int, dest="mpd_port", default=6600,
+        help="Connect to mpd using specified port (default 6600)")
+    parser.add_option(
+        "--amixer", dest="amixer", action="store_true",
+        help="Use amixer rather than libasound to control the hardware")
+    parser.add_option(
+        "--simulate", dest="simulate", metavar="SPEC",
+        help="Use a simulated mixer, configured by SPEC (eg " +
+        "'latency=8,jitter=2,errors=0.01'; see SimMixer, or '' for " +
+        "the defaults)")
+    parser.add_option(
+        "--curve", dest="curve", choices=['linear', 'db'], default='linear',
+        help="Volume curve when moode's log curve is off: linear or db")
+    parser.add_option(
+        "--poll", dest="poll", action="store_true",
+        help="Poll for volume changes rather than waiting for hw events")
+    parser.add_option(
+        "--max-rate", type=float, dest="max_rate", default=20.0,
+        help="Maximum rate of volume writes per second (default 20)")
+    parser.add_option(
+        "--queue-size", type=int, dest="queue_size", default=256,
+        help="Queue at most this many commands for each zone, merging " +
+        "or refusing any more, or 0 for no limit (default 256)")
+    parser.add_option(
+        "--client-rate", type=float, dest="client_rate", default=50.0,
+        help="Admit commands from each connection at up to this many " +
+        "per second, merging any more, or 0 for no limit (default 50)")
+    parser.add_option(
+        "--client-burst", type=int, dest="client_burst", default=100,
+        help="Allow each connection bursts of up to this many commands " +
+        "above its rate (default 100)")
+    parser.add_option(
+        "--wal", dest="wal", action="store_true",
+        help="Use sqlite's write-ahead log journal mode for the database")
+    parser.add_option(
+        "--max-age", dest="max_age", type=float, default=5.0,
+        help="Answer volume queries from memory if the hardware state " +
+        "was read or written within this many seconds (default 5)")
+    parser.add_option(
+        "-s", "--socket", dest="socket", default='/run/volumed.sock',
+        help="Also listen on this unix domain socket, or '' for none "
+        "(default /run/volumed.sock)")
+    parser.add_option(
+        "-z", "--zone", dest="zones", action="append", default=[],
+        metavar="NAME=CARD:CONTROL[:MAX_PCT]",
+        help="Also control the named zone, using the given alsa card " +
+        "(number or id) and mixer control.  May be repeated.")
+    parser.add_option(
+        "--db", dest="db",
+        help="Use this database (default db/player.db, in volumed's " +
+        "directory)")
+    parser.add_option(
+        "-g", "--group-member", dest="members", action="append",
+        default=[], metavar="HOST[:PORT][/ZONE][,offset=N][,max=N]",
+        help="Lead a volume group, relaying our volume to the volumed " +
+        "at HOST, adjusted by offset and limited to max.  May be repeated.")
+    parser.add_option(
+        "--state-file", dest="state_file",
+        help="Keep a snapshot of the volume state and hardware in this " +
+        "file, to start from on restart, or '' for none (default " +
+        "db/volumed.state, beside the database)")
+    parser.add_option(
+        "--fast-start", dest="fast_start", action="store_true",
+        help="Start answering requests from the persisted state at once, " +
+        "opening and checking the hardware in the background.  This is " +
+        "the default when started by systemd socket activation.")
+    parser.add_option(
+        "--record", dest="record", metavar="FILE",
+        help="Append a record of all traffic received to FILE, for " +
+        "replaying with volumereplay.py")
+    parser.add_option(
+        "--trace", dest="trace", type=float, default=0.0, metavar="RATE",
+        help="Trace this fraction (0 to 1) of commands (default 0: none)")
+    parser.add_option(
+        "--trace-size", dest="trace_size", type=int, default=256,
+        help="Keep this many of the most recent traces (default 256)")
     parser.add_option("-d", "--debug",  dest="debug", action="store_true",
                       help="Provide some debugging output")
 
     (options, args) = parser.parse_args()
     DEBUG = options.debug
+    TRACER.configure(options.trace, options.trace_size)
+    if options.record:
+        try:
+            RECORDER.open(options.record)
+        except IOError as e:
+            sys.stderr.write("Unable to record to %s: %s\n" %
+                             (options.record, e))
+            sys.exit(2)
+    listeners = systemd_listeners()
+    if listeners:
+        options.fast_start = True
     dirname = os.path.dirname(sys.argv[0])
-    controller = SingleVolumeController(dirname, options)
+    if options.db is None:
+        options.db = "%s/db/player.db" % dirname
+    if options.state_file is None:
+        options.state_file = os.path.join(os.path.dirname(options.db),
+                                          'volumed.state')
+    try:
+        options.zones = [parse_zone(zone) for zone in options.zones]
+        options.members = [parse_member(member)
+                           for member in options.members]
+        zones = VolumeZones(options)
+    except ValueError as e:
+        sys.stderr.write("%s\n" % e)
+        sys.exit(2)
+
+    # Sockets passed to us by systemd take the place of those given by
+    # --port and --socket.
+    local_server = None
+    if socket.AF_UNIX in listeners:
+        local_server = unix_server(None, zones, listeners[socket.AF_UNIX])
+    elif options.socket:
+        local_server = unix_server(options.socket, zones)
+    if local_server:
+        local_server.start()
+    http_listener = (listeners.get(socket.AF_INET6) or
+                     listeners.get(socket.AF_INET) or ('', options.port))
 
     try:
-        server = WSGIServer(('', 8888),
-                            WebSocketWSGIApplication(handler_cls=VolumeServer))
+        server = WSGIServer(http_listener,
+                            with_metrics(WebSocketWSGIApplication(
+                                protocols=[VolumeServer.JSON_PROTOCOL],
+                                handler_cls=VolumeServer)))
         def handleHup(signum, frame):
             print 'SIGHUP received: taking no action...'
 
+        def handleUsr1(signum, frame):
+            for trace in TRACER.dump():
+                sys.stderr.write(json.dumps(trace, sort_keys=True) + "\n")
+
         def handleTerm(signum, frame):
             print 'SIGTERM received: closing down...'
+            if local_server:
+                local_server.stop()
             server.stop()
 
         signal.signal(signal.SIGHUP, handleHup)
         signal.signal(signal.SIGTERM, handleTerm)
+        signal.signal(signal.SIGUSR1, handleUsr1)
     
         server.serve_forever()
     except KeyboardInterrupt: pass
     except Termination: pass
-    controller.stop()
-    controller.join()
+    if local_server:
+        local_server.stop()
+    if local_server and socket.AF_UNIX not in listeners:
+        try:
+            os.unlink(options.socket)
+        except OSError:
+            pass
+    zones.stop()
+    zones.join()
@@ -0,0 +1,332 @@
+#! /usr/bin/env python
+#
+# This Program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 3, as
+# published by the Free Software Foundation.
+#
+# This Program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TsunAMP; see the file COPYING.  If not, see
+# <http://www.gnu.org/licenses/>.
+#
+# Volume Control Daemon   (c) 2017 Marc Munro
+#
+# Built for Moode audio player.
+#
+# This replays traffic recorded by volumed's --record option against a
+# volumed, either at its original speed or time-scaled, so that builds
+# can be compared using real bursts of knob-dragging and remote control
+# repeats.  By default it starts its own volumed, with a simulated mixer
+# so that hardware writes are made and counted, on a port of its own.
+# It reports, as json:
+#
+# - how closely the replay kept to the recorded timing;
+# - command-to-reply latency, as seen by the replayed connections;
+# - volumed's hardware writes and reads, batch sizes, database commits
+#   and, if we started it, its CPU time and memory use.
+#
+# Each recorded connection is replayed over its own websocket, with the
+# protocol and zone that it used; connections made through volumed's
+# unix socket are replayed over websockets too.  A volumed that we
+# start is given a temporary copy of its database (db/player.db), so
+# that the replay's volume and mute changes do not find their way into
+# moode's settings.
+#
+
+import sys
+sys.path.append('/usr/local/lib/python2.7/site-packages')
+from ws4py.client.threadedclient import WebSocketClient
+import threading
+import time
+import os
+import re
+import json
+import socket
+import signal
+import subprocess
+import urllib2
+from volumec import PendingRequests
+from volumebench import percentiles, wait_for_port, process_usage, copy_db
+
+
+class ReplayClient(WebSocketClient):
+    """A websocket client replaying one recorded connection, recording
+    the latency of each reply."""
+    proto_re = re.compile("^ *proto(col)? +(text|json) *$", re.IGNORECASE)
+
+    def __init__(self, url, protocol):
+        WebSocketClient.__init__(
+            self, url,
+            protocols=['volumed-json'] if protocol == 'json' else None)
+        self.protocol = protocol
+        self.pending = PendingRequests()
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.responses = 0
+        self.sent = 0
+
+    def command(self, msg):
+        if self.protocol == 'json':
+            cmds = [cmd.strip() for cmd in re.split('[;\n]', msg)]
+            cmds = [cmd for cmd in cmds if cmd]
+        else:
+            cmds = [msg]
+        for cmd in cmds:
+            self.pending.sent(cmd)
+            match = self.proto_re.match(cmd)
+            if match:
+                self.protocol = match.group(2).lower()
+        self.sent += len(cmds)
+        self.send(msg)
+
+    def received_message(self, m):
+        with self.lock:
+            self.responses += 1
+            for line in m.data.splitlines():
+                self.latencies.extend(
+                    [latency
+                     for cmd, latency in self.pending.received(line)])
+
+
+def load_capture(path):
+    """Read a capture, returning its entries in time order."""
+    events = []
+    with open(path) as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if 't' in event and 'conn' in event:
+                events.append(event)
+    events.sort(key=lambda event: event['t'])
+    return events
+
+
+def read_metrics(address):
+    """Return volumed's metrics, as a dict keyed by series."""
+    metrics = {}
+    url = 'http://%s:%d/metrics' % address
+    for line in urllib2.urlopen(url, timeout=5).read().splitlines():
+        if line and not line.startswith('#'):
+            series, value = line.rsplit(' ', 1)
+            metrics[series] = float(value)
+    return metrics
+
+
+def summarise_metrics(before, after):
+    """Summarise the change in volumed's metrics over the replay."""
+    def delta(series):
+        return int(after.get(series, 0) - before.get(series, 0))
+
+    def total(prefix):
+        return sum([delta(series) for series in after
+                    if series.startswith(prefix)])
+
+    def hw_calls(op):
+        return delta('volumed_hw_call_seconds_count{op="%s"}' % op)
+
+    batches = delta('volumed_batch_size_count')
+    batch_sizes = {}
+    below = 0
+    for bound in [1, 2, 4, 8, 16, 32, 64, 128, '+Inf']:
+        count = delta('volumed_batch_size_bucket{le="%s"}' % bound)
+        if count - below:
+            batch_sizes['<=%s' % bound] = count - below
+        below = count
+    commands = total('volumed_commands_total')
+    return {
+        'commands': commands,
+        'hw_volume_writes': hw_calls('set_volume'),
+        'hw_mute_writes': hw_calls('set_mute'),
+        'hw_reads': hw_calls('get_volume'),
+        'batches': batches,
+        'mean_batch_size': (round(float(commands) / batches, 3)
+                            if batches else None),
+        'batch_sizes': batch_sizes,
+        'db_commits': delta('volumed_db_commit_seconds_count')}
+
+
+def connect(url, event):
+    zone = event.get('zone')
+    client = ReplayClient(url + ('/%s' % zone if zone else ''),
+                          event.get('protocol') or 'text')
+    client.connect()
+    return client
+
+
+def replay(events, options, url):
+    """Play the capture back, returning the clients used and the lag of
+    each message behind its scheduled time."""
+    clients = {}
+    lags = []
+    base = events[0]['t']
+    start = time.time()
+    for event in events:
+        due = start + (event['t'] - base) / options.speed
+        delay = due - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        if event.get('event') == 'open':
+            clients[event['conn']] = connect(url, event)
+        elif 'msg' in event:
+            client = clients.get(event['conn'])
+            if not client:
+                # The capture began after this connection was opened.
+                client = clients[event['conn']] = connect(url, {})
+            lags.append(max(0, time.time() - due))
+            client.command(event['msg'])
+        # Connections are left open until the end, so that their replies
+        # are not lost.
+    return clients.values(), lags, time.time() - start
+
+
+def run_replay(events, options):
+    if options.url:
+        host, port = options.url.rsplit(':', 1)
+        return drive(events, options, (host, int(port)), None)
+    volumed = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])),
+                           'volumed.py')
+    db = copy_db(os.path.dirname(volumed))
+    args = [sys.executable, './volumed.py', '--port', str(options.port),
+            '--socket', '', '--state-file', '', '--db', db]
+    if options.hardware:
+        args += options.volumed_args
+    elif options.emulate:
+        args += ['--emulate'] + options.volumed_args
+    else:
+        args += ['--simulate', options.simulate] + options.volumed_args
+    log = open(options.log, 'w') if options.log else open(os.devnull, 'w')
+    daemon = subprocess.Popen(args, cwd=os.path.dirname(volumed),
+                              stdout=log, stderr=subprocess.STDOUT)
+    try:
+        if not wait_for_port(options.port, 10):
+            raise RuntimeError("volumed did not start listening on port %d" %
+                               options.port)
+        return drive(events, options, ('127.0.0.1', options.port),
+                     daemon.pid)
+    finally:
+        if daemon.poll() is None:
+            daemon.send_signal(signal.SIGTERM)
+            daemon.wait()
+        os.remove(db)
+
+
+def drive(events, options, address, pid):
+    url = 'ws://%s:%d' % address
+    before = read_metrics(address)
+    usage_before = process_usage(pid) if pid else None
+    clients, lags, elapsed = replay(events, options, url)
+    # Wait for the last replies to arrive.
+    limit = time.time() + options.timeout
+    while (time.time() < limit and
+           any([client.pending.count() for client in clients])):
+        time.sleep(0.01)
+    time.sleep(0.2)
+    after = read_metrics(address)
+    usage_after = process_usage(pid) if pid else None
+    for client in clients:
+        client.close()
+    # Let the clients' threads finish before we exit.
+    limit = time.time() + 1
+    while (time.time() < limit and
+           not all([client.terminated for client in clients])):
+        time.sleep(0.01)
+
+    messages = [event for event in events if 'msg' in event]
+    results = {
+        'config': {'capture': options.capture, 'speed': options.speed,
+                   'daemon': (options.url or
+                              ('hardware' if options.hardware else
+                               'emulate' if options.emulate else
+                               'simulate')),
+                   'volumed_args': options.volumed_args},
+        'capture': {'connections': len(set([event['conn']
+                                            for event in events])),
+                    'messages': len(messages),
+                    'duration_s': round(events[-1]['t'] - events[0]['t'],
+                                        3)},
+        'elapsed_s': round(elapsed, 3),
+        'send_lag_ms': percentiles(lags),
+        'commands': sum([client.sent for client in clients]),
+        'replies': sum([client.responses for client in clients]),
+        'unanswered': sum([client.pending.count() for client in clients]),
+        'reply_latency_ms': percentiles(
+            sum([client.latencies for client in clients], [])),
+        'volumed': summarise_metrics(before, after)}
+    if pid:
+        results['volumed'].update({
+            'cpu_user_s': round(usage_after['cpu_user'] -
+                                usage_before['cpu_user'], 3),
+            'cpu_system_s': round(usage_after['cpu_system'] -
+                                  usage_before['cpu_system'], 3),
+            'rss_kb': usage_after.get('vmrss_kb'),
+            'peak_rss_kb': usage_after.get('vmhwm_kb')})
+    return results
+
+
+if __name__ == '__main__':
+    import optparse
+
+    parser = optparse.OptionParser(
+        usage="%prog [options] capture [-- volumed options]")
+    parser.add_option("-p", "--port", type=int, dest="port", default=8899,
+                      help="Run volumed on this port (default 8899)")
+    parser.add_option("-u", "--url", dest="url", metavar="HOST:PORT",
+                      help="Replay against the volumed already running " +
+                      "at HOST:PORT, rather than starting one")
+    parser.add_option("-s", "--speed", type=float, dest="speed",
+                      default=1.0,
+                      help="Replay this many times faster than recorded " +
+                      "(default 1)")
+    parser.add_option("-S", "--simulate", dest="simulate", default='',
+                      metavar="SPEC",
+                      help="Settings for volumed's simulated mixer (see " +
+                      "volumed's --simulate; default its defaults)")
+    parser.add_option("-e", "--emulate", dest="emulate",
+                      action="store_true",
+                      help="Run volumed in emulate mode, with no mixer")
+    parser.add_option("-H", "--hardware", dest="hardware",
+                      action="store_true",
+                      help="Run volumed against the real hardware")
+    parser.add_option("-t", "--timeout", type=float, dest="timeout",
+                      default=5.0,
+                      help="Seconds to wait for outstanding replies " +
+                      "(default 5)")
+    parser.add_option("-l", "--log", dest="log",
+                      help="Write volumed's output to this file")
+    parser.add_option("-o", "--output", dest="output",
+                      help="Write results to this file rather than stdout")
+
+    (options, args) = parser.parse_args()
+    if not args:
+        parser.error("no capture given")
+    if options.speed <= 0:
+        parser.error("speed must be positive")
+    options.capture = args[0]
+    options.volumed_args = args[1:]
+
+    try:
+        events = load_capture(options.capture)
+    except IOError as e:
+        sys.stderr.write("volumereplay: %s\n" % e)
+        sys.exit(1)
+    if not events:
+        sys.stderr.write("volumereplay: nothing to replay in %s\n" %
+                         options.capture)
+        sys.exit(1)
+    try:
+        results = run_replay(events, options)
+    except (RuntimeError, socket.error, urllib2.URLError) as e:
+        sys.stderr.write("volumereplay: %s\n" % e)
+        sys.exit(1)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print output